@@ -1,13 +1,37 @@
+import asyncio
 import json
+import mmap
 import os
+import struct
+import sys
+import time
 import uuid
 import hashlib
+from contextlib import contextmanager
 from datetime import datetime
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+# orjson (opcional) serializa directamente a bytes y mucho más rápido que json; si no está usamos json
+# En ambos casos el JSON es compacto: va cifrado, nadie lo lee, y cada byte de más se cifra y se escribe
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
 class JsonDatabase:
     AES_KEY_SIZE = 32  # 256 bits para K_db
     C_FILENAME = "C_value_chat.bin"
+    SAVE_DELAY = 0.05  # Segundos que esperamos para agrupar varias modificaciones en un solo guardado
+    LOG_MAX_SIZE = 1024 * 1024  # Tamaño del log a partir del cual lo compactamos en el snapshot
     
     def __init__(self, dnie_manager):
         self.dnie_manager = dnie_manager
@@ -15,15 +39,35 @@ class JsonDatabase:
         
         # Calcular nombre de archivo basado en el hash del número de serie para que sea unico por DNIe
         serial = self.dnie_manager.get_serial_number()
-        serial_hash = hashlib.sha256(str(serial).encode()).hexdigest()[:16]
+        serial_hash = hashlib.sha256(str(serial).encode()).digest()[:8].hex()  # Se calcula una sola vez
+        self.serial_hash = serial_hash
+        self._aad = serial_hash.encode()  # AAD de la DB: un archivo cifrado de otro DNIe no se puede hacer pasar por el nuestro
+        self._permitir_sin_aad = False  # Solo durante load(): aceptar archivos de versiones anteriores (sin AAD)
+        self._sin_aad = False  # load() ha encontrado datos sin AAD y hay que reescribirlos
         
         # Archivos: igual que en el gestor de contraseñas
         script_dir = os.path.dirname(os.path.abspath(__file__))
         self.archivo_C = os.path.join(script_dir, self.C_FILENAME)
         self.archivo_kdb = os.path.join(script_dir, f"kdb_enc_{serial_hash}.bin")
         self.filepath = os.path.join(script_dir, f"database_{serial_hash}.json.enc")
+        self.archivo_log = os.path.join(script_dir, f"db_log_{serial_hash}.bin")  # Cambios cifrados desde el último snapshot
         
         self.k_db_cache = None  # Caché para K_db
+        self.k_cache = None  # Caché para K (evita volver a firmar C con la tarjeta)
+        self._aesgcm_K = None  # Cifrador AES-GCM con K (key schedule ya calculado)
+        self._aesgcm = None  # Cifrador AES-GCM con K_db, reutilizado en cada guardado/carga
+        self._ops = []  # Cambios en memoria que aún no se han escrito en el log
+        self._flush_handle = None  # Guardado diferido pendiente en el event loop
+        self._tx_depth = 0  # > 0 mientras estamos dentro de transaction(): los cambios se escriben al salir
+        self._msg_json_cache = {}  # (cn, id) -> JSON ya serializado del mensaje (casi nunca cambian)
+        self._msg_by_id = {}  # cn -> {id: mensaje}; mismas referencias que en la lista "msgs"
+        self._msg_pos = {}  # cn -> {id: posición en "msgs"} (los mensajes solo se añaden al final)
+        self._pending_ids = {}  # cn -> ids de mensajes en estado "pending"
+        self._sent_ids = {}  # cn -> ids de mensajes en estado "sent" (esperando ACK)
+        self._unread_ids = {}  # cn -> ids de mensajes recibidos sin leer
+        self._peer_cert_cache = {}  # cn -> certificado del peer ya convertido de hex a bytes
+        self._addr_index = None  # (ip, puerto) -> cn; se reconstruye cuando cambian direcciones o contactos
+        self._name_index = None  # nombre en minúsculas -> cn; se reconstruye cuando cambian nombres o contactos
         
         # Inicializar C y K_db igual que el gestor
         self.inicializar_C()
@@ -47,6 +91,25 @@ class JsonDatabase:
             raise RuntimeError("Valor C inválido (longitud incorrecta).")
         return data
     
+    def _get_K(self) -> bytes:
+        # K = SHA256(firma de C con el DNIe); solo se calcula una vez por ejecución
+        if self.k_cache is None:
+            C = self.leer_C()
+            S = self.dnie_manager.sign_data(C)
+            self.k_cache = hashlib.sha256(S).digest()
+        return self.k_cache
+
+    def _cipher_K(self) -> AESGCM:
+        if self._aesgcm_K is None:
+            self._aesgcm_K = AESGCM(self._get_K())
+        return self._aesgcm_K
+
+    def _cipher_db(self) -> AESGCM:
+        # Un único objeto AESGCM por clave: no repetimos la expansión de clave en cada operación
+        if self._aesgcm is None:
+            self._aesgcm = AESGCM(self.descifrar_kdb())
+        return self._aesgcm
+    
     def inicializar_kdb(self):
         # Crea la Kdb
         if os.path.exists(self.archivo_kdb):
@@ -55,13 +118,8 @@ class JsonDatabase:
         # Crear K_db aleatoria de 256 bits
         k_db = os.urandom(self.AES_KEY_SIZE)
         
-        # Firmar C para obtener K
-        C = self.leer_C()
-        S = self.dnie_manager.sign_data(C)
-        K = hashlib.sha256(S).digest()
-        
         # Cifrar K_db con K usando AES-GCM (Similar a como lo haciamos en el gestor de contraseñas)
-        aesgcm = AESGCM(K)
+        aesgcm = self._cipher_K()
         nonce = os.urandom(12)
         ct = aesgcm.encrypt(nonce, k_db, associated_data=None)
         
@@ -85,69 +143,302 @@ class JsonDatabase:
         nonce = contenido[:12]
         ct = contenido[12:]
         
-        # Firmar C para recuperar K
-        C = self.leer_C()
-        S = self.dnie_manager.sign_data(C)
-        K = hashlib.sha256(S).digest()
-        
-        # Descifrar K_db
-        aesgcm = AESGCM(K)
+        # Descifrar K_db con K (firma de C)
+        aesgcm = self._cipher_K()
         k_db = aesgcm.decrypt(nonce, ct, associated_data=None)
         
         self.k_db_cache = k_db
         return k_db
 
     def load(self):
-        # Carga la base de datos cifrada con K_db (igual que gestor de contraseñas)
-        k_db = self.descifrar_kdb()
-        
+        # Carga el snapshot cifrado con K_db (igual que gestor de contraseñas) y le aplica el log
+        aesgcm = self._cipher_db()
+        self._permitir_sin_aad = True  # Lo primero que se lea (snapshot o, si no hay, el log) decide si aceptamos datos sin AAD
+        self._sin_aad = False
+        self.data = self.leer_snapshot(aesgcm)
+        self._msg_by_id = {}
+        self._msg_pos = {}
+        for cn, c in self.data["contacts"].items():
+            por_id = self._msg_by_id[cn] = {}
+            pos = self._msg_pos[cn] = {}
+            for i, m in enumerate(c.get("msgs", ())):
+                if "id" in m:
+                    por_id[m["id"]] = m
+                    pos[m["id"]] = i
+        self.replay_log(aesgcm)
+        self._permitir_sin_aad = False  # A partir de aquí siempre exigimos el AAD
+        self.clean_duplicates()
+        self._addr_index = None
+        self._name_index = None
+        self._pending_ids = {}
+        self._sent_ids = {}
+        self._unread_ids = {}
+        for cn, por_id in self._msg_by_id.items():
+            for m in por_id.values():
+                self._internar(m)
+                self._indexar_estado(cn, m)
+        if self._sin_aad:  # Datos de una versión anterior: los reescribimos ya con AAD (snapshot nuevo y log vacío)
+            self._sin_aad = False
+            self.compact()
+
+    def _descifrar(self, aesgcm, nonce, ct):
+        # Descifra con el AAD del DNIe; sin AAD solo se acepta al cargar archivos guardados con versiones anteriores
+        try:
+            datos = aesgcm.decrypt(nonce, ct, associated_data=self._aad)
+        except InvalidTag:
+            if not self._permitir_sin_aad:
+                raise
+            datos = aesgcm.decrypt(nonce, ct, associated_data=None)
+            self._sin_aad = True
+        self._permitir_sin_aad = self._sin_aad  # Si lo primero que leemos ya lleva AAD, todo lo demás también debe llevarlo
+        return datos
+
+    def leer_snapshot(self, aesgcm):
         if not os.path.exists(self.filepath):
-            self.data = {"contacts": {}}
-            return
+            return {"contacts": {}}
         
         try:
-            with open(self.filepath, "rb") as f:
-                contenido = f.read()
+            if os.path.getsize(self.filepath) == 0:
+                return {"contacts": {}}
             
-            if not contenido:
-                self.data = {"contacts": {}}
-                return
+            # Mapeamos el archivo en memoria y desciframos directamente sobre él (sin copias intermedias)
+            with open(self.filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as contenido:
+                    # Descifrar con K_db usando AES-GCM
+                    nonce = bytes(contenido[:12])
+                    datos_bytes = self._descifrar(aesgcm, nonce, contenido[12:])
+            data = _loads(datos_bytes)
             
-            # Descifrar con K_db usando AES-GCM
-            nonce = contenido[:12]
-            ct = contenido[12:]
-            aesgcm = AESGCM(k_db)
-            datos_bytes = aesgcm.decrypt(nonce, ct, associated_data=None)
-            self.data = json.loads(datos_bytes.decode("utf-8"))
-            
-            if "contacts" not in self.data:
-                self.data["contacts"] = {}
-            self.clean_duplicates()
+            if "contacts" not in data:
+                data["contacts"] = {}
+            return data
         except Exception as e:
             print(f"Error al cargar DB cifrada: {e}")
-            self.data = {"contacts": {}}
+            return {"contacts": {}}
+
+    def replay_log(self, aesgcm):
+        # Aplica sobre el snapshot los cambios guardados en el log (len(4B) + nonce + ct por bloque)
+        if not os.path.exists(self.archivo_log):
+            return
+        with open(self.archivo_log, "rb") as f:
+            contenido = f.read()
+        offset = 0
+        while offset + 16 <= len(contenido):
+            (longitud,) = struct.unpack_from(">I", contenido, offset)
+            fin = offset + 16 + longitud
+            if fin > len(contenido):
+                break  # Bloque incompleto (cierre a mitad de escritura): lo ignoramos
+            nonce = contenido[offset + 4:offset + 16]
+            try:
+                ops = _loads(self._descifrar(aesgcm, nonce, contenido[offset + 16:fin]))
+            except Exception as e:
+                print(f"Error al leer el log de la DB: {e}")
+                break
+            for op in ops:
+                self.aplicar_op(op)
+            offset = fin
+        if offset < len(contenido):
+            # Recortamos lo que no se pudo leer para que los siguientes bloques queden detrás de uno válido
+            with open(self.archivo_log, "r+b") as f:
+                f.truncate(offset)
 
-    def save(self):
+    def aplicar_op(self, op):
+        # Reaplica un cambio del log; todas las operaciones son idempotentes
+        contacts = self.data["contacts"]
+        cn = op.get("cn")
+        tipo = op.get("op")
+        if tipo == "contact":
+            contacto = contacts.setdefault(cn, {"msgs": []})
+            contacto.update(op["campos"])
+        elif tipo == "msg":
+            msgs = contacts.setdefault(cn, {"msgs": []})["msgs"]
+            msg = op["msg"]
+            por_id = self._msg_by_id.setdefault(cn, {})
+            existente = por_id.get(msg.get("id"))
+            if existente is not None:
+                existente.clear()
+                existente.update(msg)
+            else:
+                msgs.append(msg)
+                if "id" in msg:
+                    por_id[msg["id"]] = msg
+                    self._msg_pos.setdefault(cn, {})[msg["id"]] = len(msgs) - 1
+        elif tipo == "del":
+            contacts.pop(cn, None)
+            self._msg_by_id.pop(cn, None)
+            self._msg_pos.pop(cn, None)
+
+    def save(self, durable=False):
         # Guarda la base de datos cifrada con K_db (igual que gestor de contraseñas)
         try:
-            k_db = self.descifrar_kdb()
-            
             # Cifrar con K_db usando AES-GCM
-            aesgcm = AESGCM(k_db)
+            aesgcm = self._cipher_db()
             nonce = os.urandom(12)
-            json_str = json.dumps(self.data, indent=2, ensure_ascii=False)
-            ct = aesgcm.encrypt(nonce, json_str.encode("utf-8"), associated_data=None)
+            ct = aesgcm.encrypt(nonce, self._serializar(), associated_data=self._aad)
             
-            # Guardar nonce + ct
-            with open(self.filepath, "wb") as f:
-                f.write(nonce + ct)
+            # Guardar nonce + ct en un temporal y sustituir el archivo de golpe (un corte no deja la DB a medias)
+            # Dos escrituras seguidas: así no copiamos todo el texto cifrado en un bytes nuevo solo para concatenar
+            tmp = self.filepath + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(nonce)
+                f.write(ct)
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.filepath)
+            return True
         except Exception as e:
             print(f"Error al guardar DB: {e}")
+            return False
+
+    def compact(self):
+        # Vuelca todo a un snapshot nuevo y vacía el log (solo si el snapshot ya está en disco)
+        if self.save(durable=True):
+            with open(self.archivo_log, "wb"):
+                pass
+
+    def _append_ops(self, ops, durable=False):
+        # Cifra los cambios pendientes como un bloque y lo añade al final del log
+        try:
+            aesgcm = self._cipher_db()
+            nonce = os.urandom(12)
+            ct = aesgcm.encrypt(nonce, _dumps(ops), associated_data=self._aad)
+            with open(self.archivo_log, "ab") as f:
+                f.write(struct.pack(">I", len(ct)))
+                f.write(nonce)
+                f.write(ct)
+                if durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+                size = f.tell()
+        except Exception as e:
+            print(f"Error al guardar DB: {e}")
+            return
+        if size > self.LOG_MAX_SIZE:
+            self.compact()
+
+    def _serializar(self) -> bytes:
+        # Genera el JSON de la base de datos reutilizando los fragmentos cacheados de los mensajes
+        cache = self._msg_json_cache
+        secciones = []
+        for clave, valor in self.data.items():
+            if clave != "contacts":
+                secciones.append(_dumps(clave) + b":" + _dumps(valor))
+                continue
+            contactos = []
+            for cn, info in valor.items():
+                campos = []
+                for campo, dato in info.items():
+                    if campo != "msgs":
+                        campos.append(_dumps(campo) + b":" + _dumps(dato))
+                        continue
+                    partes = []
+                    for m in dato:
+                        msg_id = m.get("id")
+                        fragmento = cache.get((cn, msg_id)) if msg_id else None
+                        if fragmento is None:
+                            fragmento = _dumps(m)
+                            if msg_id:
+                                cache[(cn, msg_id)] = fragmento
+                        partes.append(fragmento)
+                    campos.append(b'"msgs":[' + b",".join(partes) + b"]")
+                contactos.append(_dumps(cn) + b":{" + b",".join(campos) + b"}")
+            secciones.append(b'"contacts":{' + b",".join(contactos) + b"}")
+        return b"{" + b",".join(secciones) + b"}"
+
+    def _invalidar_msg(self, cn, msg):
+        # El mensaje ha cambiado: su JSON cacheado ya no vale
+        self._msg_json_cache.pop((cn, msg.get("id")), None)
+
+    def _registrar(self, op):
+        # Apunta un cambio para el log y programa su escritura
+        self._ops.append(op)
+        self._schedule_save()
+
+    def _registrar_msg(self, cn, msg):
+        self._invalidar_msg(cn, msg)
+        self._indexar_estado(cn, msg)
+        self._registrar({"op": "msg", "cn": cn, "msg": msg})
+
+    @staticmethod
+    def _internar(msg):
+        # El remitente y el estado se repiten en miles de mensajes: compartimos una sola copia de cada string
+        for campo in ("sender", "status"):
+            valor = msg.get(campo)
+            if type(valor) is str:
+                msg[campo] = sys.intern(valor)
+
+    def _indexar_estado(self, cn, msg):
+        # Mantiene al día los conjuntos de pendientes y no leídos según el estado del mensaje
+        msg_id = msg.get("id")
+        if msg_id is None:
+            return
+        status = msg.get("status")
+        pendientes = self._pending_ids.setdefault(cn, set())
+        if status == "pending":
+            pendientes.add(msg_id)
+        else:
+            pendientes.discard(msg_id)
+        enviados = self._sent_ids.setdefault(cn, set())
+        if status == "sent":
+            enviados.add(msg_id)
+        else:
+            enviados.discard(msg_id)
+        no_leidos = self._unread_ids.setdefault(cn, set())
+        if status == "received" and not msg.get("read", False):
+            no_leidos.add(msg_id)
+        else:
+            no_leidos.discard(msg_id)
+
+    def _schedule_save(self):
+        # Agrupa los cambios pendientes: como mucho un bloque en el log cada SAVE_DELAY
+        if self._flush_handle is not None or self._tx_depth:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Sin event loop (arranque o scripts) guardamos directamente
+            self._flush()
+            return
+        self._flush_handle = loop.call_later(self.SAVE_DELAY, self._flush)
+
+    def _flush(self, durable=False):
+        # Escribe a disco los cambios pendientes (un solo json.dumps + cifrado + escritura)
+        self._flush_handle = None
+        if not self._ops:
+            return
+        ops, self._ops = self._ops, []
+        self._append_ops(ops, durable)
+
+    @contextmanager
+    def transaction(self):
+        # Agrupa todos los cambios hechos dentro del bloque en un solo bloque del log, que se programa al salir
+        self._tx_depth += 1
+        try:
+            yield self
+        finally:
+            self._tx_depth -= 1
+            if not self._tx_depth and self._ops:
+                self._schedule_save()
+
+    def flush(self, durable=False):
+        # Fuerza la escritura de los cambios pendientes; durable=True además hace fsync (al cerrar la aplicación)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush(durable)
 
     def get_all_contacts(self):
+        # Devuelve el propio diccionario de contactos en memoria (sin copiarlo ni consultar nada): llamarla es O(1)
+        # y siempre está al día, así que no hace falta cachear el resultado; no hay que modificarlo desde fuera
         return self.data.get("contacts", {})
 
     def add_or_update_contact(self, cn, **kwargs):
+        campos = self._actualizar_contacto(cn, kwargs)
+        if campos:
+            self._registrar({"op": "contact", "cn": cn, "campos": campos})
+
+    def _actualizar_contacto(self, cn, kwargs):
+        # Crea o actualiza el contacto en memoria y devuelve los campos que han cambiado (para el log)
         if cn not in self.data["contacts"]:
             self.data["contacts"][cn] = {
                 "name": kwargs.get("name", cn),
@@ -159,43 +450,78 @@ class JsonDatabase:
                 "session_key": None,
                 "peer_cert": None
             }
-        else:
-            for key, value in kwargs.items():
-                if key in ["name", "ip", "port", "session_key", "peer_cert"]:
-                    self.data["contacts"][cn][key] = value
-        self.save()
+            self._addr_index = None
+            self._name_index = None
+            return {k: v for k, v in self.data["contacts"][cn].items() if k != "msgs"}
+        contacto = self.data["contacts"][cn]
+        campos = {}
+        for key, value in kwargs.items():
+            # Solo guardamos lo que cambia: en cada reconexión llegan los mismos datos
+            if key in ["name", "ip", "port", "session_key", "peer_cert"] and contacto.get(key) != value:
+                if key in ("ip", "port"):
+                    self._addr_index = None  # Cambia la dirección del contacto
+                elif key == "session_key" and value and not contacto.get(key):
+                    self._addr_index = None  # Ahora tiene clave de sesión: puede pasar a ser el preferido de su dirección
+                elif key == "name":
+                    self._name_index = None
+                contacto[key] = value
+                campos[key] = value
+        if "peer_cert" in campos:
+            self._peer_cert_cache.pop(cn, None)
+        return campos
+
+    def _cambiar_conexion(self, contacto, connected):
+        # Aplica el estado de conexión y devuelve los campos a guardar ({} si ya estaba conectado)
+        if connected and contacto.get("is_connected"):
+            return {}
+        contacto["is_connected"] = connected
+        if not connected:
+            contacto["last_seen"] = datetime.now().isoformat()
+        return {"is_connected": connected, "last_seen": contacto["last_seen"]}
 
     def set_contact_connected(self, cn, connected):
         # Pone el contacto como conectado
         if cn in self.data["contacts"]:
-            self.data["contacts"][cn]["is_connected"] = connected
-            if not connected:
-                self.data["contacts"][cn]["last_seen"] = datetime.now().isoformat()
-            self.save()
+            campos = self._cambiar_conexion(self.data["contacts"][cn], connected)
+            if campos:
+                self._registrar({"op": "contact", "cn": cn, "campos": campos})
 
-    def add_message(self, cn, sender, text, status="received", timestamp=None, msg_id=None):
-        # Añade los mensajes a la base de datos
+    def upsert_contact_state(self, cn, is_connected=None, **kwargs):
+        # add_or_update_contact + set_contact_connected en una sola entrada del log (is_connected=None: no se toca)
+        campos = self._actualizar_contacto(cn, kwargs)
+        if is_connected is not None:
+            campos.update(self._cambiar_conexion(self.data["contacts"][cn], is_connected))
+        if campos:
+            self._registrar({"op": "contact", "cn": cn, "campos": campos})
+
+    def add_message(self, cn, sender, text, status="received", timestamp=None, msg_id=None, read=False):
+        # Añade los mensajes a la base de datos (read=True: ya leído, p. ej. llega con su chat abierto)
         if cn not in self.data["contacts"]:
             self.add_or_update_contact(cn)
         
         if msg_id:
-            for existing_msg in self.data["contacts"][cn]["msgs"]:
-                if existing_msg.get("id") == msg_id:
-                    return msg_id
+            if msg_id in self._msg_by_id.get(cn, ()):
+                return msg_id
         else:
             msg_id = str(uuid.uuid4())
         
+        now = time.time()
         msg = {
             "id": msg_id,
-            "sender": sender,
+            "sender": sys.intern(sender) if type(sender) is str else sender,
             "text": text,
-            "timestamp": timestamp or datetime.now().isoformat(),
+            "timestamp": timestamp or now,  # Epoch en segundos; la TUI le da formato al mostrarlo
             "status": status,
-            "read": False,
-            "sent_timestamp": datetime.now().timestamp() if status == "sent" else None
+            "read": read,
+            "sent_timestamp": now if status == "sent" else None
         }
-        self.data["contacts"][cn]["msgs"].append(msg)
-        self.save()
+        msgs = self.data["contacts"][cn]["msgs"]
+        msgs.append(msg)
+        self._msg_by_id.setdefault(cn, {})[msg_id] = msg
+        self._msg_pos.setdefault(cn, {})[msg_id] = len(msgs) - 1
+        self._indexar_estado(cn, msg)
+        self._msg_json_cache[(cn, msg_id)] = _dumps(msg)
+        self._registrar({"op": "msg", "cn": cn, "msg": msg})
         return msg_id
 
     def get_history(self, cn):
@@ -204,72 +530,92 @@ class JsonDatabase:
             return []
         return self.data["contacts"][cn].get("msgs", [])
 
+    def has_user_messages(self, cn):
+        # ¿Hay algún mensaje que no sea del sistema? Paramos en el primero (normalmente el segundo del historial)
+        return any(m.get("sender") != "Sys" for m in self.get_history(cn))
+
+    def get_history_tail(self, cn, limit, before_id=None):
+        # Últimos `limit` mensajes de un contacto (los anteriores a before_id si se indica), sin recorrer el historial
+        msgs = self.get_history(cn)
+        end = len(msgs)
+        if before_id is not None:
+            end = self._msg_pos.get(cn, {}).get(before_id)
+            if end is None:
+                return []
+        return msgs[max(0, end - limit):end]
+
     def mark_message_status(self, cn, msg_id, status):
         # Ponemos el mensaje en el estatus que le corresponde 
-        if cn not in self.data["contacts"]:
+        msg = self._msg_by_id.get(cn, {}).get(msg_id)
+        if msg is None:
             return
-        for msg in self.data["contacts"][cn]["msgs"]:
-            if msg.get("id") == msg_id:
-                msg["status"] = status
-                if status == "sent":
-                    msg["sent_timestamp"] = datetime.now().timestamp()
-                elif status == "delivered":
-                    msg["sent_timestamp"] = None
-                elif status == "pending":
-                    msg["sent_timestamp"] = None
-                self.save()
-                return
+        msg["status"] = status
+        if status == "sent":
+            msg["sent_timestamp"] = time.time()
+        elif status == "delivered":
+            msg["sent_timestamp"] = None
+        elif status == "pending":
+            msg["sent_timestamp"] = None
+        self._registrar_msg(cn, msg)
  
+    def mark_messages_status_batch(self, cn, msg_ids, status, from_status=None):
+        # Cambia el estado de varios mensajes en una sola escritura; con from_status solo los que siguen en ese estado
+        # (p. ej. no pasar a "sent" uno cuyo ACK ya ha llegado)
+        por_id = self._msg_by_id.get(cn, {})
+        with self.transaction():
+            for msg_id in msg_ids:
+                msg = por_id.get(msg_id)
+                if msg is not None and (from_status is None or msg.get("status") == from_status):
+                    self.mark_message_status(cn, msg_id, status)
+
     def get_pending_messages(self, cn):
-        # Obtenemos mensajes pendientes
-        return [m for m in self.get_history(cn) if m["status"] == "pending"]
+        # Obtenemos mensajes pendientes (en el orden del historial) sin recorrer todo el historial
+        pendientes = self._pending_ids.get(cn)
+        if not pendientes:
+            return []
+        por_id = self._msg_by_id[cn]
+        return [por_id[i] for i in sorted(pendientes, key=self._msg_pos[cn].__getitem__)]
 
-    def get_unread_count(self, cn, my_nick):
-        # Obtenemos mensajes que no han sido leidos
-        if cn not in self.data["contacts"]:
-            return 0
-        msgs = self.data["contacts"][cn]["msgs"]
-        return sum(1 for m in msgs if m.get("status") == "received" and not m.get("read", False))
+    def get_unread_counts_bulk(self, my_nick):
+        # Mensajes sin leer de todos los contactos de una vez (cn -> número)
+        return {cn: len(ids) for cn, ids in self._unread_ids.items() if ids}
 
     def mark_messages_as_read(self, cn, my_nick):
         # Marcamos los mensajes como leidos
-        if cn not in self.data["contacts"]:
+        no_leidos = self._unread_ids.get(cn)
+        if not no_leidos:
             return
-        msgs = self.data["contacts"][cn]["msgs"]
-        changed = False
-        for m in msgs:
-            if m.get("status") == "received" and not m.get("read", False):
-                m["read"] = True
-                changed = True
-        if changed:
-            self.save()
-
-    def mark_message_as_read_by_id(self, cn, msg_id):
-        # Marcamos los mensajes como leidos en función de su ip
-        if cn not in self.data["contacts"]:
-            return
-        for msg in self.data["contacts"][cn]["msgs"]:
-            if msg.get("id") == msg_id:
-                msg["read"] = True
-                self.save()
-                return
-
-    def check_message_timeouts(self, cn, timeout_seconds=2):
-        # Marcamos el timeout de los mensajes
-        if cn not in self.data["contacts"]:
-            return False
-        now = datetime.now().timestamp()
-        has_timeout = False
-        for msg in self.data["contacts"][cn]["msgs"]:
-            if msg.get("status") == "sent" and msg.get("sent_timestamp"):
-                elapsed = now - msg["sent_timestamp"]
-                if elapsed > timeout_seconds:
-                    msg["status"] = "pending"
-                    msg["sent_timestamp"] = None
-                    has_timeout = True
-        if has_timeout:
-            self.save()
-        return has_timeout
+        por_id = self._msg_by_id[cn]
+        for msg_id in list(no_leidos):
+            m = por_id[msg_id]
+            m["read"] = True
+            self._registrar_msg(cn, m)
+
+    def revert_sent_to_pending(self, cn):
+        # Todos los mensajes "sent" del contacto vuelven a "pending" (se reenviarán al reconectar); devuelve sus ids
+        ids = list(self._sent_ids.get(cn, ()))
+        with self.transaction():
+            for msg_id in ids:
+                self.mark_message_status(cn, msg_id, "pending")
+        return ids
+
+    def batch_get_timed_out_contacts(self, timeout_seconds=2, exclude=()):
+        # Barrido de timeouts de ACK de todos los contactos conectados en una sola pasada, mirando solo los mensajes "sent"
+        # Si un contacto tiene algún mensaje sin ACK en más de timeout_seconds, todos sus "sent" vuelven a "pending"
+        # Devuelve [(cn, ip, puerto, ids_devueltos_a_pending)]
+        now = time.time()
+        vencidos = []
+        for cn, enviados in self._sent_ids.items():
+            if not enviados or cn in exclude:
+                continue
+            contacto = self.data["contacts"].get(cn)
+            if not contacto or not contacto.get("is_connected"):
+                continue
+            por_id = self._msg_by_id[cn]
+            if any(now - (por_id[i].get("sent_timestamp") or now) > timeout_seconds for i in enviados):
+                vencidos.append((cn, contacto))
+        # Revertimos fuera del bucle: hacerlo dentro modificaría los conjuntos que estamos recorriendo
+        return [(cn, contacto.get("ip"), contacto.get("port"), self.revert_sent_to_pending(cn)) for cn, contacto in vencidos]
 
     def get_session_key(self, cn):
         # Obtiene la session_key guardada para un contacto es decir, la clave compartida
@@ -279,48 +625,70 @@ class JsonDatabase:
             return session_key_hex  # Devuelve como string hex, protocol.py lo convierte
         return None
 
+    def get_contact_by_addr(self, ip, port):
+        # Contacto con esa dirección (el primero que tenga clave de sesión, si no el primero); None si no hay
+        if self._addr_index is None:
+            index = {}
+            for cn, info in self.data["contacts"].items():
+                addr = (info.get("ip"), info.get("port"))
+                prev = index.get(addr)
+                if prev is None or (info.get("session_key") and not self.data["contacts"][prev].get("session_key")):
+                    index[addr] = cn
+            self._addr_index = index
+        return self._addr_index.get((ip, port))
+
+    def get_contact_by_name(self, name):
+        # Primer contacto con ese nombre (sin distinguir mayúsculas ni espacios alrededor); None si no hay
+        if self._name_index is None:
+            index = {}
+            for cn, info in self.data["contacts"].items():
+                index.setdefault(info.get("name", "").strip().lower(), cn)
+            self._name_index = index
+        return self._name_index.get(name.strip().lower())
+
     def get_contact_info(self, cn):
-        # Obtiene toda la info de un contacto
+        # Obtiene toda la info de un contacto: el propio dict en memoria (el que guardamos y el que protocol.py actualiza),
+        # no una copia; una tupla con nombre costaría crearla en cada llamada y dejaría de estar al día con el primer cambio
         return self.data["contacts"].get(cn,{})
 
     def get_peer_cert(self, cn):
-        # Obtenemos el certificado del peer
+        # Obtenemos el certificado del peer (solo se decodifica el hex la primera vez)
+        if cn in self._peer_cert_cache:
+            return self._peer_cert_cache[cn]
         if cn not in self.data["contacts"]:
             return None
         cert_hex = self.data["contacts"][cn].get("peer_cert")
         if cert_hex:
-            return bytes.fromhex(cert_hex)
+            cert = bytes.fromhex(cert_hex)
+            self._peer_cert_cache[cn] = cert
+            return cert
         return None
 
     def clean_duplicates(self):
         # Eliminamos duplicados(limpieza y organización de la TUI)
-        contacts_to_remove = []
-        contacts_by_name = {}
-        for cn, info in list(self.data["contacts"].items()):
+        # Una sola pasada: por cada nombre nos quedamos con el contacto con más mensajes;
+        # si ninguno tiene mensajes, preferimos el identificado por "ip:puerto"
+        best = {}  # nombre -> (cn, número de mensajes)
+        for cn, info in self.data["contacts"].items():
             name = info.get("name")
-            if name:
-                if name not in contacts_by_name:
-                    contacts_by_name[name] = []
-                contacts_by_name[name].append(cn)
-        for name, contact_ids in contacts_by_name.items():
-            if len(contact_ids) > 1:
-                best_cn = None
-                max_msgs = -1
-                for cn in contact_ids:
-                    msgs_count = len(self.data["contacts"][cn].get("msgs", []))
-                    if msgs_count > max_msgs:
-                        max_msgs = msgs_count
-                        best_cn = cn
-                if max_msgs == 0:
-                    for cn in contact_ids:
-                        if ":" in cn:
-                            best_cn = cn
-                            break
-                for cn in contact_ids:
-                    if cn != best_cn:
-                        contacts_to_remove.append(cn)
+            if not name:
+                continue
+            n = len(info.get("msgs", ()))
+            prev = best.get(name)
+            if prev is None or n > prev[1] or (n == prev[1] == 0 and ":" in cn and ":" not in prev[0]):
+                best[name] = (cn, n)
+        contacts_to_remove = [
+            cn for cn, info in self.data["contacts"].items()
+            if info.get("name") and best[info["name"]][0] != cn
+        ]
         for cn in contacts_to_remove:
-            if cn in self.data["contacts"]:
-                del self.data["contacts"][cn]
-        if contacts_to_remove:
-            self.save()
+            del self.data["contacts"][cn]
+            self._msg_by_id.pop(cn, None)
+            self._msg_pos.pop(cn, None)
+            self._pending_ids.pop(cn, None)
+            self._sent_ids.pop(cn, None)
+            self._unread_ids.pop(cn, None)
+            self._peer_cert_cache.pop(cn, None)
+            self._addr_index = None
+            self._name_index = None
+            self._registrar({"op": "del", "cn": cn})
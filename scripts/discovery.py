@@ -16,12 +16,14 @@ class DiscoveryService:
         self.browser = None # AsyncServiceBrowser
         # Usar IP manual si se proporciona, sino autodetectar
         self.my_ip = my_ip if my_ip else self.get_lan_ip()
+        self._my_ip_packed = socket.inet_aton(self.my_ip) # IP en binario (como llega en info.addresses)
          
         # ID único para evitar choques si reinicias rápido el programa
         self.unique_id = str(uuid.uuid4())[:8]
         self.my_name = f"dni-im-{self.unique_id}.{config.SERVICE_TYPE}" # Nombre del servicio(Casi nunca se utiliza)
 
-    def get_lan_ip(self):
+    @staticmethod
+    def get_lan_ip():
         # Detecta la IP real de la LAN para anunciar correctamente.
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # No se envía nada, solo se calcula la ruta hacia Google DNS
@@ -46,7 +48,7 @@ class DiscoveryService:
         info = ServiceInfo(
             config.SERVICE_TYPE,
             self.my_name,
-            addresses=[socket.inet_aton(self.my_ip)],
+            addresses=[self._my_ip_packed],
             port=self.port,
             properties={"nick": self.nick},
             server=f"{socket.gethostname()}.local.",
@@ -74,9 +76,13 @@ class DiscoveryService:
             found = await info.async_request(zeroconf, 2000) # Esperamos hasta 2s para resolver
             
             if found and info.addresses:
-                ip = socket.inet_ntoa(info.addresses[0])
+                addr = info.addresses[0]
                 port = info.port
                 
+                # Filtro: No añadirnos a nosotros mismos (comparamos en binario, sin convertir)
+                if addr == self._my_ip_packed and port == self.port: return
+                ip = socket.inet_ntoa(addr)
+                
                 # Intentar extraer nick de las propiedades
                 peer_nick = name.split(".")[0]
                 if info.properties and b'nick' in info.properties:
@@ -86,9 +92,6 @@ class DiscoveryService:
                             peer_nick = nick_val.decode('utf-8')
                     except: pass
 
-                # Filtro: No añadirnos a nosotros mismos
-                if ip == self.my_ip and port == self.port: return
-
                 # Avisar a la TUI para mostrarlo
                 self.on_peer(peer_nick, ip, port)
         except Exception: 
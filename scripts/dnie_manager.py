@@ -21,8 +21,23 @@ class DNIeManager:
             format=serialization.PublicFormat.Raw
         )
         
+        self._sign_cache = {}  # Firmas ya calculadas por la tarjeta: datos -> firma
+        self._session = None  # Sesión PKCS#11 abierta durante toda la ejecución (un solo login con el PIN)
+        self._priv_key_auth = None  # Clave de autenticación
+        self._priv_key_sign = None  # Clave de firma
+        
         # Intentamos extraer credenciales. Si falla, el error sube (no hacemos sys.exit)
         self.cert_der, self.firma_cached = self.extraer_credenciales()
+        
+        # Parseamos el certificado una sola vez y guardamos lo que se consulta después
+        self.cert = x509.load_der_x509_certificate(self.cert_der, default_backend())
+        self.serial_number = self.cert.serial_number
+        cn_attrs = self.cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        if cn_attrs:
+            raw = cn_attrs[0].value
+            self.cn = raw.replace("(AUTENTICACIÓN)", "").replace("(Autenticación)", "").replace("(FIRMA)", "").replace("(Firma)", "").strip()
+        else:
+            self.cn = "Usuario Desconocido"
 
     def get_token(self): # Obtenemos el token
         pkcs11 = pkcs11_lib(self.lib_path)
@@ -33,7 +48,8 @@ class DNIeManager:
 
     def extraer_credenciales(self): # Extraemos credenciales
         token = self.get_token()
-        with token.open(user_pin=self.pin, rw=True) as session:
+        session = token.open(user_pin=self.pin, rw=True) # La sesión queda abierta hasta close()
+        try:
             certs = list(session.get_objects({Attribute.CLASS: ObjectClass.CERTIFICATE}))
             if not certs: raise RuntimeError("No certificados.")
             cert_der = certs[0][Attribute.VALUE] 
@@ -41,35 +57,44 @@ class DNIeManager:
             keys = list(session.get_objects({Attribute.CLASS: ObjectClass.PRIVATE_KEY}))
             if not keys: raise RuntimeError("No clave privada.")
 
-            priv_key = keys[0] # Usamos la clave de autenticación
+            self._priv_key_auth = keys[0] # Usamos la clave de autenticación
+            self._priv_key_sign = keys[1] if len(keys) > 1 else None
             
-            firma = priv_key.sign(self.public_bytes, mechanism=Mechanism.SHA256_RSA_PKCS)
-            return cert_der, firma
+            firma = self._priv_key_auth.sign(self.public_bytes, mechanism=Mechanism.SHA256_RSA_PKCS)
+        except Exception:
+            session.close()
+            raise
+        self._session = session
+        return cert_der, firma
     
     def obtener_credenciales(self):
         # Obtenemos las credenciales necesarias
         return self.cert_der, self.firma_cached
 
     def get_user_name(self):
-        # Extraer nombre para mostrarlo
-        try:
-            cert = x509.load_der_x509_certificate(self.cert_der, default_backend())
-            cn = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
-            return cn.replace("(AUTENTICACIÓN)", "").strip()
-        except:
-            return "Usuario DNIe"
+        # Nombre para mostrarlo (ya extraído del certificado)
+        return self.cn
 
     def get_serial_number(self):
         # Devuelve el número de serie del certificado para el nombre de la base de datos 
-        cert = x509.load_der_x509_certificate(self.cert_der, default_backend())
-        return cert.serial_number
+        return self.serial_number
  
     def sign_data(self, data: bytes) -> bytes:
         # Firma datos arbitrarios usando la clave privada del DNIe
-        token = self.get_token()
-        with token.open(user_pin=self.pin, rw=True) as session:
-            keys = list(session.get_objects({Attribute.CLASS: ObjectClass.PRIVATE_KEY}))
-            if not keys:
-                raise RuntimeError("No clave privada.")
-            priv_key = keys[1]
-            return priv_key.sign(data, mechanism=Mechanism.SHA256_RSA_PKCS)
\ No newline at end of file
+        # PKCS#1 v1.5 es determinista, así que reutilizamos la firma en vez de volver a la tarjeta
+        if data in self._sign_cache:
+            return self._sign_cache[data]
+        if self._priv_key_sign is None:
+            raise RuntimeError("No clave privada.")
+        firma = self._priv_key_sign.sign(data, mechanism=Mechanism.SHA256_RSA_PKCS)
+        self._sign_cache[data] = firma
+        return firma
+
+    def close(self):
+        # Cierra la sesión PKCS#11 al salir de la aplicación
+        if self._session is not None:
+            try:
+                self._session.close()
+            except Exception:
+                pass
+            self._session = None
\ No newline at end of file
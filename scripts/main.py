@@ -4,15 +4,8 @@ import sys
 import config
 from getpass import getpass
 
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.x509.oid import NameOID
-
-from dnie_manager import DNIeManager
-from protocol import SecureIMProtocol
-from discovery import DiscoveryService
-from tui import ChatTUI
-from database import JsonDatabase
+# Los módulos que cargan cryptography/pkcs11/prompt_toolkit/zeroconf se importan dentro de main(),
+# después de pedir el PIN, para que el prompt aparezca cuanto antes
 
 async def main():
     # Parsear argumentos: python main.py [IP] [PUERTO]
@@ -40,17 +33,13 @@ async def main():
     try:
         pin = getpass("Introduce PIN DNIe: ")
         print("⌛ Leyendo tarjeta...")
+        from dnie_manager import DNIeManager
+        from database import JsonDatabase
         dnie = DNIeManager(pin)
         
         db = JsonDatabase(dnie)
         
-        cert = x509.load_der_x509_certificate(dnie.cert_der, default_backend())
-        cn_attrs = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
-        if cn_attrs:
-            raw = cn_attrs[0].value
-            my_nick = raw.replace("(AUTENTICACIÓN)", "").replace("(Autenticación)", "").replace("(FIRMA)", "").replace("(Firma)", "").strip()
-        else:
-            my_nick = "Usuario Desconocido"
+        my_nick = dnie.cn # Nombre ya extraído del certificado del DNIe
 
     except Exception as e:
         print(f"Error al leer DNIe: {e}")
@@ -59,14 +48,14 @@ async def main():
     def protocol_callback(addr, text, nombre, msg_id=None):
         tui.on_protocol_msg(addr, text, nombre, msg_id)
 
+    from protocol import SecureIMProtocol
+    from discovery import DiscoveryService
+    from tui import ChatTUI
+
     protocol = SecureIMProtocol(dnie, db, protocol_callback)
     
     # Usar IP manual si se especificó, sino autodetectar
-    if manual_ip:
-        my_ip = manual_ip
-    else:
-        mdns_temp = DiscoveryService(port, my_nick, lambda n, i, p: None)
-        my_ip = mdns_temp.get_lan_ip()
+    my_ip = manual_ip if manual_ip else DiscoveryService.get_lan_ip()
     
     tui = ChatTUI(protocol, my_nick, db, my_ip, port)
     
@@ -88,12 +77,18 @@ async def main():
     try:
         await tui.run()
     finally:
-        await mdns.stop()
+        try:
+            await mdns.stop()
+        finally: # Aunque falle el mDNS, guardamos la BD y cerramos la tarjeta
+            try:
+                db.flush(durable=True) # Escribimos (con fsync) los cambios que queden pendientes antes de salir
+            finally:
+                dnie.close() # Cerramos la sesión con la tarjeta
  
 if __name__ == "__main__":
     if sys.platform == 'win32':
-        # Usar ProactorEventLoop en Windows para mejor manejo de UDP
-        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+        # SelectorEventLoop en Windows: atiende los timers de asyncio a tiempo sin tener que despertar el loop con tráfico propio
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     
     try:
         asyncio.run(main())
@@ -1,13 +1,63 @@
 import asyncio
-import struct
+import socket
 import os
+import re
 import hashlib
+from collections import deque
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.primitives.asymmetric import x25519, padding
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.backends import default_backend
 import config
+import udp_batch
+
+# libsodium (PyNaCl) elige en tiempo de ejecución la implementación SIMD de ChaCha20-Poly1305 (SSSE3/AVX2)
+# Si no está instalado usamos la de cryptography; el formato (nonce de 12 bytes + tag de 16) es el mismo
+try:
+    from nacl import bindings as _sodium
+except ImportError:
+    _sodium = None
+
+if _sodium is not None:
+    class AEAD: # ChaCha20-Poly1305 (IETF) con la misma interfaz que el ChaCha20Poly1305 de cryptography
+        def __init__(self, key):
+            self._key = bytes(key)
+
+        # PyNaCl solo acepta bytes: bytes(x) no copia si ya lo es, y convierte los memoryview de los paquetes recibidos
+        def encrypt(self, nonce, data, associated_data):
+            return _sodium.crypto_aead_chacha20poly1305_ietf_encrypt(bytes(data), associated_data, bytes(nonce), self._key)
+
+        def decrypt(self, nonce, data, associated_data):
+            return _sodium.crypto_aead_chacha20poly1305_ietf_decrypt(bytes(data), associated_data, bytes(nonce), self._key)
+else:
+    AEAD = ChaCha20Poly1305
+
+# Sufijos que el DNIe añade al CN del certificado y que quitamos para mostrar el nombre
+_CN_SUFIJOS = re.compile(r"\((?:AUTENTICACIÓN|Autenticación|FIRMA|Firma)\)")
+RECONNECT_TIMEOUT = 0.1  # Segundos sin respuesta del peer tras un RECONNECT_REQ para darlo por perdido
+EPH_POOL_SIZE = 8  # Claves efímeras X25519 generadas por adelantado
+CACHE_MAX = 128  # Entradas máximas de las cachés de certificados y claves públicas de los peers
+
+def _cache_get(cache, key): # Consulta con LRU: lo que se usa pasa al final
+    value = cache.pop(key, None)
+    if value is not None:
+        cache[key] = value
+    return value
+
+def _cache_put(cache, key, value):
+    if len(cache) >= CACHE_MAX:
+        cache.pop(next(iter(cache))) # Sacamos la entrada menos usada
+    cache[key] = value
+
+# Derivación de claves con BLAKE2b y una cadena "personal" distinta para cada uso (separación de dominio)
+KDF_EPHEMERAL = b"DNIeIM-efimera"  # Clave temporal para cifrar el certificado en el handshake
+KDF_SESSION = b"DNIeIM-sesion"  # Clave de sesión de los mensajes
+
+def kdf(secret, person):
+    if _sodium is not None:
+        return _sodium.crypto_generichash_blake2b_salt_personal(secret, digest_size=32, person=person)
+    return hashlib.blake2b(secret, digest_size=32, person=person).digest() # Mismo resultado que libsodium
 
 # Definición de los diferentes tipos de paquetes que tenemos
 # IMPORTANTE: PKT_MSG y siguientes mantienen sus valores originales para compatibilidad
@@ -30,44 +80,145 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         self.callback = on_msg_callback
         self.sessions = {}
         self.my_cid = os.urandom(4)
+        # Cabecera (tipo + cid) de cada tipo de paquete, fija durante toda la ejecución
+        self._hdr = {t: bytes([t]) + self.my_cid for t in (
+            PKT_EPHEMERAL_KEY, PKT_MSG, PKT_ACK, PKT_RECONNECT_REQ, PKT_RECONNECT_RESP,
+            PKT_PENDING_SEND, PKT_PENDING_DONE, PKT_HANDSHAKE_INIT, PKT_HANDSHAKE_RESP
+        )}
         self.handshake_in_progress = {}
         self.reconnect_pending = {}
         self.role = {}
         self.pending_sent = {}
         # Claves efímeras para encriptar el certificado durante el handshake
         self.ephemeral_keys = {}  # {addr: {'private': key, 'peer_public': key, 'temp_cipher': cipher}}
+        # En cada reconexión el peer manda el mismo certificado y la misma clave pública: no los volvemos a parsear
+        self._cert_cache = {}  # blake2s(cert) -> nombre limpio
+        self._pub_cache = {}  # bytes de la clave pública X25519 -> X25519PublicKey
+        self._cert_hex_cache = {}  # blake2s(cert) -> certificado en hex (como se guarda en la DB)
+        # Cola de envío: los paquetes que se mandan en la misma vuelta del event loop salen juntos con sendmmsg
+        self._send_queue = deque()
+        self._flush_handle = None
+        self._fd = None  # Descriptor del socket para sendmmsg (None si no se puede usar)
+        self._tx_sock = None  # Copia del socket para enviar paquetes en trozos con sendmsg
+        self._rx_fd = None  # Copia del descriptor en la que leemos con recvmmsg (None si lee el transporte)
+        self._receptor = None
+        # Claves efímeras ya generadas; cada una se usa en un solo handshake (se saca del pool al usarla)
+        self._eph_pool = deque()
+        self._eph_refill = None
+        # Tipo de paquete -> handler(payload, addr)
+        self._dispatch = {
+            PKT_EPHEMERAL_KEY: self.handle_ephemeral_key,
+            PKT_HANDSHAKE_INIT: lambda payload, addr: self.handle_handshake(payload, addr, is_response=False),
+            PKT_HANDSHAKE_RESP: lambda payload, addr: self.handle_handshake(payload, addr, is_response=True),
+            PKT_MSG: self.handle_message,
+            PKT_ACK: self.handle_ack,
+            PKT_RECONNECT_REQ: self.handle_reconnect_req,
+            PKT_RECONNECT_RESP: self.handle_reconnect_resp,
+            PKT_PENDING_SEND: self.handle_pending_send,
+            PKT_PENDING_DONE: self.handle_pending_done,
+        }
 
     def connection_made(self, transport): # Al establecer la conexión
         self.transport = transport
+        self._rellenar_claves_efimeras()
+        sock = transport.get_extra_info('socket')
+        if sock is not None and hasattr(socket.socket, 'sendmsg'):
+            self._tx_sock = socket.socket(fileno=os.dup(sock.fileno())) # Comparte el socket (y el modo no bloqueante)
+        if udp_batch.disponible() and sock is not None and sock.family == socket.AF_INET:
+            self._fd = sock.fileno()
+            loop = asyncio.get_event_loop()
+            if udp_batch.recv_disponible() and isinstance(loop, asyncio.SelectorEventLoop) and hasattr(transport, 'pause_reading'):
+                # Leemos nosotros los datagramas en lotes (recvmmsg): el transporte deja de leer y
+                # registramos un duplicado del descriptor (el loop no deja añadir lectores al de un transporte)
+                transport.pause_reading()
+                self._rx_fd = os.dup(self._fd)
+                self._receptor = udp_batch.Receptor(self._rx_fd)
+                loop.add_reader(self._rx_fd, self._leer_lote)
         if self.callback:
             self.callback(None, "SESSIONS_READY", "System", None)
 
+    def connection_lost(self, exc):
+        if self._tx_sock is not None:
+            self._tx_sock.close()
+            self._tx_sock = None
+        if self._rx_fd is not None:
+            asyncio.get_event_loop().remove_reader(self._rx_fd)
+            os.close(self._rx_fd)
+            self._rx_fd = None
+            self._receptor = None
+
+    def _leer_lote(self): # Lee de golpe todos los datagramas que haya (hasta RECV_BATCH) y los procesa uno a uno
+        try:
+            lote = self._receptor.recibir()
+        except OSError:
+            return # Nada que leer todavía, o error de red en un envío anterior (igual que ignora el transporte)
+        for data, addr in lote:
+            self.datagram_received(data, addr) # data es una vista del buffer de recepción: los handlers no la guardan
+
     def datagram_received(self, data, addr): # Al recibir un paquete
         if len(data) < 5:
             return
-        msg_type = data[0]
-        payload = data[5:]
+        handler = self._dispatch.get(data[0])
+        # Los handlers reciben una vista del datagrama (sin copiar el payload); cortarla tampoco copia
+        # Si necesitan guardar algo más allá de la llamada, lo convierten a bytes
+        payload = memoryview(data)[5:]
         
         self.touch_session(addr)
         
-        if msg_type == PKT_EPHEMERAL_KEY:
-            self.handle_ephemeral_key(payload, addr)
-        elif msg_type == PKT_HANDSHAKE_INIT:
-            asyncio.create_task(self.handle_handshake(payload, addr, is_response=False))
-        elif msg_type == PKT_HANDSHAKE_RESP:
-            asyncio.create_task(self.handle_handshake(payload, addr, is_response=True))
-        elif msg_type == PKT_MSG:
-            self.handle_message(payload, addr)
-        elif msg_type == PKT_ACK:
-            self.handle_ack(payload, addr)
-        elif msg_type == PKT_RECONNECT_REQ:
-            asyncio.create_task(self.handle_reconnect_req(payload, addr))
-        elif msg_type == PKT_RECONNECT_RESP:
-            asyncio.create_task(self.handle_reconnect_resp(payload, addr))
-        elif msg_type == PKT_PENDING_SEND:
-            asyncio.create_task(self.handle_pending_send(payload, addr))
-        elif msg_type == PKT_PENDING_DONE:
-            self.handle_pending_done(payload, addr)
+        if handler is not None:
+            handler(payload, addr)
+
+    def _enviar(self, packet, addr): # Envía un paquete; si ya se ha enviado otro en esta vuelta, lo encola
+        if self._flush_handle is None:
+            self._enviar_ya(packet, addr) # El primero sale sin esperar (no añadimos latencia a envíos sueltos)
+            self._flush_handle = asyncio.get_event_loop().call_soon(self._vaciar_cola)
+        else:
+            self._send_queue.append((packet, addr))
+
+    def _vaciar_cola(self): # Manda los paquetes encolados en lotes de hasta BATCH_MAX por llamada al sistema
+        self._flush_handle = None
+        cola = self._send_queue
+        if self.transport is None or self.transport.is_closing():
+            cola.clear()
+            return
+        while cola:
+            lote = [cola.popleft() for _ in range(min(len(cola), udp_batch.BATCH_MAX))]
+            enviados = 0
+            # Si el transporte tiene datos en buffer, seguimos usándolo para no adelantarlos
+            if self._fd is not None and len(lote) > 1 and not self.transport.get_write_buffer_size():
+                try:
+                    enviados = udp_batch.sendmmsg(self._fd, lote)
+                except OSError:
+                    enviados = 0
+            for packet, addr in lote[enviados:]:
+                self._enviar_ya(packet, addr) # Lo que no se pudo mandar en lote (o sin sendmmsg)
+
+    def _enviar_ya(self, packet, addr): # Envía un paquete (bytes o tupla de trozos) sin pasar por la cola
+        if isinstance(packet, tuple):
+            # Los trozos van directos al kernel con sendmsg, sin unirlos antes (si el transporte no tiene nada pendiente)
+            if self._tx_sock is not None and not self.transport.get_write_buffer_size():
+                try:
+                    self._tx_sock.sendmsg(packet, [], 0, addr)
+                    return
+                except (BlockingIOError, InterruptedError):
+                    pass # Buffer del socket lleno: que lo guarde y reintente el transporte
+                except OSError as exc:
+                    self.error_received(exc)
+                    return
+            packet = b"".join(packet)
+        self.transport.sendto(packet, addr)
+
+    def _tomar_clave_efimera(self): # Saca una clave efímera del pool (o la genera si está vacío) y programa el relleno
+        clave = self._eph_pool.popleft() if self._eph_pool else x25519.X25519PrivateKey.generate()
+        if self._eph_refill is None:
+            # Rellenamos cuando el event loop termine con el paquete actual, fuera del camino del handshake
+            self._eph_refill = asyncio.get_event_loop().call_soon(self._rellenar_claves_efimeras)
+        return clave
+
+    def _rellenar_claves_efimeras(self):
+        self._eph_refill = None
+        while len(self._eph_pool) < EPH_POOL_SIZE:
+            self._eph_pool.append(x25519.X25519PrivateKey.generate())
 
     def touch_session(self, addr): # Actualiza el timestamp para evitar timeout mientras hablamos
         if addr in self.reconnect_pending:
@@ -79,29 +230,29 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
             if len(payload) < 32:
                 return
             
-            peer_ephemeral_pub_bytes = payload[:32]
+            peer_ephemeral_pub_bytes = bytes(payload[:32]) # Se guarda en ephemeral_keys: necesitamos bytes
             
             # Determinar si soy el iniciador o el responder
             is_initiator = addr in self.ephemeral_keys
             
             # Generar mi clave efímera si no existe (soy el responder)
             if not is_initiator:
-                my_ephemeral_private = x25519.X25519PrivateKey.generate()
+                my_ephemeral_private = self._tomar_clave_efimera()
                 self.ephemeral_keys[addr] = {
                     'private': my_ephemeral_private,
                     'public_bytes': my_ephemeral_private.public_key().public_bytes_raw()
                 }
                 # Enviar mi clave efímera de vuelta
-                packet = struct.pack("B", PKT_EPHEMERAL_KEY) + self.my_cid + self.ephemeral_keys[addr]['public_bytes']
-                self.transport.sendto(packet, addr)
+                packet = self._hdr[PKT_EPHEMERAL_KEY] + self.ephemeral_keys[addr]['public_bytes']
+                self._enviar(packet, addr)
             
             # Calcular secreto compartido efímero
             peer_ephemeral_key = x25519.X25519PublicKey.from_public_bytes(peer_ephemeral_pub_bytes)
             ephemeral_shared = self.ephemeral_keys[addr]['private'].exchange(peer_ephemeral_key)
-            temp_key = hashlib.blake2s(ephemeral_shared, digest_size=32).digest()
+            temp_key = kdf(ephemeral_shared, KDF_EPHEMERAL)
             
             # Crear cifrador temporal para el certificado
-            self.ephemeral_keys[addr]['temp_cipher'] = ChaCha20Poly1305(temp_key)
+            self.ephemeral_keys[addr]['temp_cipher'] = AEAD(temp_key)
             self.ephemeral_keys[addr]['peer_public'] = peer_ephemeral_pub_bytes
             
             # Enviar certificado cifrado INMEDIATAMENTE
@@ -115,7 +266,7 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         except Exception:
             pass
     
-    async def handle_handshake(self, payload, addr, is_response): # Lo que ocurre en el handshake
+    def handle_handshake(self, payload, addr, is_response): # Lo que ocurre en el handshake
         if addr in self.sessions:
             return
         
@@ -131,7 +282,7 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
             if len(payload) < 44:  # 32 (pub key) + 12 (nonce) mínimo
                 return
             
-            peer_pub_bytes = payload[offset:offset+32]
+            peer_pub_bytes = bytes(payload[offset:offset+32]) # from_public_bytes exige bytes
             offset += 32
             
             nonce = payload[offset:offset+12]
@@ -148,42 +299,37 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
                     del self.ephemeral_keys[addr]
                 return
             
-            try:
-                cert_obj = x509.load_der_x509_certificate(cert_bytes, default_backend()) # Carga del certificado
-                cn_attrs = cert_obj.subject.get_attributes_for_oid(NameOID.COMMON_NAME) # Obtención de información del dni
-                if cn_attrs:
-                    raw = str(cn_attrs[0].value)
-                    nombre = raw.replace("(AUTENTICACIÓN)", "").replace("(Autenticación)", "").replace("(FIRMA)", "").replace("(Firma)", "").strip() # Nos quedamos con el nombre limpio
-                else:
-                    nombre = "DNIe Desconocido"
-            except:
-                nombre = "Error Certificado"
+            clave_cert = hashlib.blake2s(cert_bytes, digest_size=16).digest()
+            nombre = self.nombre_certificado(cert_bytes, clave_cert)
             
-            peer_key_obj = x25519.X25519PublicKey.from_public_bytes(peer_pub_bytes) # Obtención de la clave pública del otro usuario
+            peer_key_obj = _cache_get(self._pub_cache, peer_pub_bytes)
+            if peer_key_obj is None:
+                peer_key_obj = x25519.X25519PublicKey.from_public_bytes(peer_pub_bytes) # Obtención de la clave pública del otro usuario
+                _cache_put(self._pub_cache, peer_pub_bytes, peer_key_obj)
             shared_secret = self.dnie.private_key.exchange(peer_key_obj) # Secreto compartido  que solo conocen los dos usuarios, con mi clave privada y la del otro usuario
-            session_key = hashlib.blake2s(shared_secret, digest_size=32).digest() # Generación de la clave de sesión
+            session_key = kdf(shared_secret, KDF_SESSION) # Generación de la clave de sesión
             
             self.sessions[addr] = { # Guardamos la sesión
-                'cipher': ChaCha20Poly1305(session_key),
+                'cipher': AEAD(session_key),
                 'name': nombre,
                 'state': 'ESTABLISHED'
             }
             
-            existing_cn = None
-            all_contacts = self.db.get_all_contacts()
-            for cn, info in all_contacts.items():
-                if info.get("ip") == addr[0] and info.get("port") == addr[1]:
-                    existing_cn = cn
-                    break
+            existing_cn = self.db.get_contact_by_addr(addr[0], addr[1])
             
             contact_id = existing_cn if existing_cn else nombre
+            # El certificado solo se pasa a hex (2-4 KB) la primera vez; la DB solo escribe los campos que cambian
+            cert_hex = _cache_get(self._cert_hex_cache, clave_cert)
+            if cert_hex is None:
+                cert_hex = cert_bytes.hex()
+                _cache_put(self._cert_hex_cache, clave_cert, cert_hex)
             self.db.add_or_update_contact(
                 contact_id,
                 name=nombre,
                 ip=addr[0],
                 port=addr[1],
                 session_key=session_key.hex(),
-                peer_cert=cert_bytes.hex()
+                peer_cert=cert_hex
             )
             
             if is_response: # Si somos los que iniciamos el handshake
@@ -203,24 +349,46 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         except Exception:
             pass
 
+    def nombre_certificado(self, cert_bytes, clave=None): # Nombre limpio del CN del certificado (cacheado por hash del certificado)
+        if clave is None:
+            clave = hashlib.blake2s(cert_bytes, digest_size=16).digest()
+        nombre = _cache_get(self._cert_cache, clave)
+        if nombre is not None:
+            return nombre
+        try:
+            cert_obj = x509.load_der_x509_certificate(cert_bytes, default_backend()) # Carga del certificado
+            cn_attrs = cert_obj.subject.get_attributes_for_oid(NameOID.COMMON_NAME) # Obtención de información del dni
+            if cn_attrs:
+                nombre = _CN_SUFIJOS.sub("", str(cn_attrs[0].value)).strip() # Nos quedamos con el nombre limpio
+            else:
+                nombre = "DNIe Desconocido"
+        except Exception:
+            return "Error Certificado" # No lo cacheamos
+        _cache_put(self._cert_cache, clave, nombre)
+        return nombre
+
     def handle_message(self, payload, addr): # Manejamos el mensaje que nos llega 
         if addr not in self.sessions:
             return
         session = self.sessions[addr]
         cipher = session['cipher']
         nombre = session.get('name', 'Unknown')
+        # Un solo socket en un solo event loop: se descifra aquí, en el orden de llegada. Repartir el tráfico entre varios
+        # sockets SO_REUSEPORT con un loop por hilo obligaría a compartir sessions, claves efímeras y la BD entre hilos
         try:
             nonce = payload[:12]
             ciphertext = payload[12:]
             plaintext = cipher.decrypt(nonce, ciphertext, None)
-            msg_data = plaintext.decode('utf-8')
-            
-            if '|' in msg_data:
-                msg_id, msg = msg_data.split('|', 1)
-                self.enviar_ack(addr[0], addr[1], msg_id)
+            # Separamos en bytes ('|' es ASCII, no aparece dentro de un carácter UTF-8 multibyte)
+            # así el id vuelve en el ACK tal cual llegó, sin decodificarlo y volverlo a codificar
+            if b'|' in plaintext:
+                id_bytes, texto = plaintext.split(b'|', 1)
+                msg = texto.decode('utf-8')
+                msg_id = id_bytes.decode('utf-8')
+                self.enviar_ack(addr[0], addr[1], id_bytes)
             else:
                 msg_id = None
-                msg = msg_data
+                msg = plaintext.decode('utf-8')
             
             if self.callback:
                 self.callback(addr, msg, nombre, msg_id)
@@ -246,13 +414,12 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
                 contact_name = contact_info.get("name", cn)
         
         if not saved_key:
-            all_contacts = self.db.get_all_contacts()
-            for name, info in all_contacts.items():
-                if info.get("ip") == ip and info.get("port") == port:
-                    saved_key = info.get("session_key")
-                    if saved_key:
-                        contact_name = info.get("name", name)
-                        break
+            name = self.db.get_contact_by_addr(ip, port)
+            if name:
+                info = self.db.get_contact_info(name)
+                saved_key = info.get("session_key")
+                if saved_key:
+                    contact_name = info.get("name", name)
         
         if saved_key: 
             try:
@@ -262,16 +429,21 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
                     session_key = saved_key
 
                 self.sessions[addr] = {
-                    'cipher': ChaCha20Poly1305(session_key),
+                    'cipher': AEAD(session_key),
                     'name': contact_name,
                     'state': 'ESTABLISHED'
                 }
                 
                 final_cn = cn if cn else contact_name
                 
+                loop = asyncio.get_event_loop()
+                anterior = self.reconnect_pending.get(addr)
+                if anterior:
+                    anterior['handle'].cancel()
                 self.reconnect_pending[addr] = {
                     'cn': final_cn,
-                    'timestamp': asyncio.get_event_loop().time()
+                    'timestamp': loop.time(),
+                    'handle': loop.call_later(RECONNECT_TIMEOUT, self._on_reconnect_timeout, addr) # Temporizador propio, sin sondeo
                 }
                 
                 self.enviar_reconnect_req(ip, port)
@@ -290,7 +462,7 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         try:
             addr = (ip, port)
             # Generar nueva clave efímera para este handshake
-            my_ephemeral_private = x25519.X25519PrivateKey.generate()
+            my_ephemeral_private = self._tomar_clave_efimera()
             public_bytes = my_ephemeral_private.public_key().public_bytes_raw()
             
             self.ephemeral_keys[addr] = {
@@ -299,8 +471,8 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
             }
             
             # Enviar solo la clave pública efímera
-            packet = struct.pack("B", PKT_EPHEMERAL_KEY) + self.my_cid + public_bytes
-            self.transport.sendto(packet, (ip, port))
+            packet = self._hdr[PKT_EPHEMERAL_KEY] + public_bytes
+            self._enviar(packet, (ip, port))
             # El certificado se enviará automáticamente cuando reciba la clave efímera del peer
         except Exception:
             pass
@@ -310,7 +482,7 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         if addr in self.sessions:
             del self.sessions[addr]
         if addr in self.reconnect_pending:
-            del self.reconnect_pending[addr]
+            self.reconnect_pending.pop(addr)['handle'].cancel()
         if addr in self.role:
             del self.role[addr]
         if addr in self.pending_sent:
@@ -334,43 +506,66 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
             temp_cipher = self.ephemeral_keys[addr]['temp_cipher']
             
             # Cifrar el certificado con la clave temporal
-            nonce = os.urandom(12)
-            encrypted_cert = temp_cipher.encrypt(nonce, cert, None)
-            
             # Paquete: tipo | cid | public_key_X25519 | nonce | certificado_cifrado
-            packet = (
-                struct.pack("B", tipo) + self.my_cid + 
-                self.dnie.public_bytes + nonce + encrypted_cert
-            )
-            self.transport.sendto(packet, (ip, port))
+            nonce = os.urandom(12)
+            packet = self._paquete_cifrado(self._hdr[tipo] + self.dnie.public_bytes, temp_cipher, nonce, cert)
+            self._enviar(packet, (ip, port))
         except Exception:
             pass
 
+    def _siguiente_nonce(self, session): # Nonce de los mensajes de una sesión: prefijo aleatorio (8 bytes) + contador (4 bytes)
+        # La clave de sesión se reutiliza al reconectar y la usan los dos extremos, así que el contador solo no basta:
+        # cada sesión en memoria saca su propio prefijo aleatorio (una sola llamada a urandom en vez de una por paquete)
+        # El nonce va en cada paquete a propósito: con UDP se pierden y desordenan datagramas, y un cifrado en
+        # flujo (tipo secretstream de libsodium) dejaría la sesión inservible con el primer paquete perdido
+        n = session.get('nonce_ctr', 0)
+        if n > 0xFFFFFFFF or 'nonce_prefix' not in session:
+            session['nonce_prefix'] = os.urandom(8)
+            n = 0
+        session['nonce_ctr'] = n + 1
+        return session['nonce_prefix'] + n.to_bytes(4, 'big')
+
+    def _paquete_cifrado(self, prefijo, cipher, nonce, data): # Construye prefijo | nonce | cifrado (en un buffer o en trozos)
+        if hasattr(cipher, 'encrypt_into'):
+            # cryptography puede cifrar directamente dentro del paquete: una sola reserva y ninguna concatenación
+            # Un buffer por paquete (no uno compartido): los paquetes encolados o en el buffer del transporte lo siguen usando
+            inicio = len(prefijo) + 12
+            packet = bytearray(inicio + len(data) + 16) # 16 = tag de Poly1305
+            packet[:len(prefijo)] = prefijo
+            packet[len(prefijo):inicio] = nonce
+            cipher.encrypt_into(nonce, data, None, memoryview(packet)[inicio:])
+            return packet
+        # Si no, devolvemos los trozos sin unir: se envían con sendmsg/sendmmsg como un solo datagrama (iovec)
+        return (prefijo, nonce, cipher.encrypt(nonce, data, None))
+
     def enviar_mensaje(self, ip, port, texto, msg_id=None): # Encio del mensaje
         addr = (ip, port)
         if addr not in self.sessions:
             return False
         try:
-            cipher = self.sessions[addr]['cipher']
-            nonce = os.urandom(12)
+            session = self.sessions[addr]
+            cipher = session['cipher']
+            nonce = self._siguiente_nonce(session)
             msg_data = f"{msg_id}|{texto}" if msg_id else texto
-            ciphertext = cipher.encrypt(nonce, msg_data.encode('utf-8'), None) # Encriptamos con la clave compartida
-            packet = struct.pack("B", PKT_MSG) + self.my_cid + nonce + ciphertext
-            self.transport.sendto(packet, addr)
+            # Se cifra aquí mismo y no en un hilo: ChaCha20-Poly1305 sobre un datagrama (<= 64 KB) cuesta decenas de µs,
+            # menos que el despacho al executor, y así los paquetes salen siempre en el orden en que se envían
+            packet = self._paquete_cifrado(self._hdr[PKT_MSG], cipher, nonce, msg_data.encode('utf-8')) # Encriptamos con la clave compartida
+            self._enviar(packet, addr)
             return True
         except:
             return False
 
-    def enviar_ack(self, ip, port, msg_id): # Mandamos ACK cifrado 
+    def enviar_ack(self, ip, port, msg_id): # Mandamos ACK cifrado (msg_id en str o ya en bytes)
         addr = (ip, port)
         if addr not in self.sessions:
             return
         try:
-            cipher = self.sessions[addr]['cipher']
-            nonce = os.urandom(12)
-            ciphertext = cipher.encrypt(nonce, msg_id.encode('utf-8'), None)
-            packet = struct.pack("B", PKT_ACK) + self.my_cid + nonce + ciphertext
-            self.transport.sendto(packet, addr)
+            session = self.sessions[addr]
+            cipher = session['cipher']
+            nonce = self._siguiente_nonce(session)
+            data = msg_id if isinstance(msg_id, bytes) else msg_id.encode('utf-8')
+            packet = self._paquete_cifrado(self._hdr[PKT_ACK], cipher, nonce, data)
+            self._enviar(packet, addr)
         except:
             pass
 
@@ -393,40 +588,40 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
     def enviar_reconnect_req(self, ip, port): # Enviamos el paquete de tipo reconnect request
         if not self.transport:
             return
-        packet = struct.pack("B", PKT_RECONNECT_REQ) + self.my_cid
-        self.transport.sendto(packet, (ip, port))
+        packet = self._hdr[PKT_RECONNECT_REQ]
+        self._enviar(packet, (ip, port))
 
     def enviar_reconnect_resp(self, ip, port): # Enviamos el paqeute de tipo reconnct response
         if not self.transport:
             return
-        packet = struct.pack("B", PKT_RECONNECT_RESP) + self.my_cid
-        self.transport.sendto(packet, (ip, port))
+        packet = self._hdr[PKT_RECONNECT_RESP]
+        self._enviar(packet, (ip, port))
 
-    async def handle_reconnect_req(self, payload, addr):
+    def handle_reconnect_req(self, payload, addr):
         # Recibe REQ: si tengo session_key guardada, restauro y respondo si no da error(Evitamos man in the middle)
-        all_contacts = self.db.get_all_contacts()
-        for cn, info in all_contacts.items():
-            if info.get("ip") == addr[0] and info.get("port") == addr[1] and info.get("session_key"):
-                try:
-                    session_key = bytes.fromhex(info.get("session_key"))
-                    self.sessions[addr] = {
-                        'cipher': ChaCha20Poly1305(session_key),
-                        'name': info.get("name", cn),
-                        'state': 'ESTABLISHED'
-                    }
-                    self.db.set_contact_connected(cn, True)
-                    self.role[addr] = "responder"
-                    self.enviar_reconnect_resp(addr[0], addr[1])
-                    if self.callback:
-                        self.callback(addr, "SESSION_RESTORED_RESP", info.get("name", cn), None)
-                    return
-                except Exception:
-                    pass
+        cn = self.db.get_contact_by_addr(addr[0], addr[1])
+        info = self.db.get_contact_info(cn) if cn else None
+        if info and info.get("session_key"):
+            try:
+                session_key = bytes.fromhex(info.get("session_key"))
+                self.sessions[addr] = {
+                    'cipher': AEAD(session_key),
+                    'name': info.get("name", cn),
+                    'state': 'ESTABLISHED'
+                }
+                self.db.set_contact_connected(cn, True)
+                self.role[addr] = "responder"
+                self.enviar_reconnect_resp(addr[0], addr[1])
+                if self.callback:
+                    self.callback(addr, "SESSION_RESTORED_RESP", info.get("name", cn), None)
+            except Exception:
+                pass
 
-    async def handle_reconnect_resp(self, payload, addr):
+    def handle_reconnect_resp(self, payload, addr):
         # Recibe RESP a mi REQ: confirmo que soy initiator
         if addr in self.reconnect_pending:
             info = self.reconnect_pending.pop(addr)
+            info['handle'].cancel()
             cn = info['cn']
             if addr in self.sessions:
                 self.role[addr] = "initiator"
@@ -440,8 +635,8 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         if not self.transport:
             return
         try:
-            packet = struct.pack("B", PKT_PENDING_SEND) + self.my_cid
-            self.transport.sendto(packet, (ip, port))
+            packet = self._hdr[PKT_PENDING_SEND]
+            self._enviar(packet, (ip, port))
         except Exception:
             pass
 
@@ -450,12 +645,12 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
         if not self.transport:
             return
         try:
-            packet = struct.pack("B", PKT_PENDING_DONE) + self.my_cid
-            self.transport.sendto(packet, (ip, port))
+            packet = self._hdr[PKT_PENDING_DONE]
+            self._enviar(packet, (ip, port))
         except Exception:
             pass
 
-    async def handle_pending_send(self, payload, addr):
+    def handle_pending_send(self, payload, addr):
         # Recibe PENDING_SEND: el peer va a mandar sus pendientes
         if addr not in self.sessions:
             return
@@ -476,24 +671,22 @@ class SecureIMProtocol(asyncio.DatagramProtocol): # Clase que implementa el prot
             if self.callback:
                 self.callback(addr, "SEND_MY_PENDING", nombre, None)
 
-    async def check_reconnect_timeouts(self):
-        # Comprueba los timeouts de los reconnets
-        while True:
-            await asyncio.sleep(1)
-            
-            current_time = asyncio.get_event_loop().time()
-            timeout_addrs = []
-            
-            for addr, info in list(self.reconnect_pending.items()):
-                if current_time - info['timestamp'] > 0.1:
-                    timeout_addrs.append(addr)
-            
-            for addr in timeout_addrs:
-                info = self.reconnect_pending.pop(addr)
-                cn = info['cn']
-                
-                if addr in self.sessions:
-                    del self.sessions[addr]
-                
-                if self.callback:
-                    self.callback(addr, "RECONNECT_TIMEOUT", cn, None)
\ No newline at end of file
+    def _on_reconnect_timeout(self, addr): # Salta RECONNECT_TIMEOUT después del REQ (o del último paquete recibido del peer)
+        info = self.reconnect_pending.get(addr)
+        if info is None:
+            return
+        loop = asyncio.get_event_loop()
+        restante = info['timestamp'] + RECONNECT_TIMEOUT - loop.time()
+        if restante > 0:
+            # touch_session solo mueve el timestamp (no toca el temporizador): esperamos lo que falte
+            info['handle'] = loop.call_later(restante, self._on_reconnect_timeout, addr)
+            return
+        
+        self.reconnect_pending.pop(addr)
+        cn = info['cn']
+        
+        if addr in self.sessions:
+            del self.sessions[addr]
+        
+        if self.callback:
+            self.callback(addr, "RECONNECT_TIMEOUT", cn, None)
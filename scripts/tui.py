@@ -1,9 +1,16 @@
 # Importación de módulos necesarios para la interfaz gráfica de texto (TUI)
 import asyncio  
+from bisect import bisect_left  # Búsqueda binaria e inserción ordenada en la lista (ordenada) de contactos
 import json  
 import os  
+import time  # Marca de tiempo (epoch) de los mensajes nuevos: nada de strftime al recibir o enviar, "HH:MM" solo al dibujarlos
 import unicodedata  # Para calcular el ancho visual de caracteres Unicode (emojis ocupan 2 espacios)
+try:
+    from wcwidth import wcswidth, wcwidth  # Ancho en terminal de cada carácter, en C (viene con prompt_toolkit)
+except ImportError:
+    wcswidth = None
 from datetime import datetime, timedelta  # Para gestionar marcas de tiempo (timestamps) de los mensajes
+from functools import lru_cache  # Memoización de funciones puras (formato de fechas, anchos, nombres, sugerencias)
 
 # Importaciones de prompt_toolkit
 from prompt_toolkit.application import Application  # Aplicación principal que gestiona toda la TUI
@@ -14,7 +21,157 @@ from prompt_toolkit.key_binding import KeyBindings  # Sistema para capturar ataj
 from prompt_toolkit.data_structures import Point  # Estructura para indicar posición del cursor (x, y)
 from prompt_toolkit.styles import Style  # Sistema de estilos CSS-like para colorear la interfaz
 
+@lru_cache(maxsize=4096)
+def _parse_timestamp(timestamp):  # Marca de tiempo guardada -> (fecha o None, "HH:MM"); cada valor se parsea una sola vez
+    if isinstance(timestamp, (int, float)): # Marca de tiempo numérica (epoch) guardada por la base de datos
+        dt = datetime.fromtimestamp(timestamp)
+        return dt.date(), f"{dt.hour:02d}:{dt.minute:02d}"
+    if timestamp: # Si hay marca de tiempo en texto (ISO o "HH:MM"), intentamos parsearla
+        try:
+            dt = datetime.fromisoformat(timestamp)  # Parseamos ISO format
+            return dt.date(), f"{dt.hour:02d}:{dt.minute:02d}"
+        except:
+            # Si falla el parseo, usar el string tal cual
+            return None, timestamp if len(timestamp) <= 5 else "??:??"
+    return None, "??:??"  # Timestamp desconocido
+
+@lru_cache(maxsize=4096)
+def _formato_fecha(time_str, msg_date, today):  # Formatea timestamps de forma amigable ("Hoy 12:30", "Ayer 09:15"...)
+    if msg_date is None:  # Solo tenemos "HH:MM": se considera de hoy si es una hora válida
+        try:
+            datetime.strptime(time_str, "%H:%M")
+        except:  # Si falla el parseo, devolver el string original
+            return time_str
+        return f"Hoy {time_str}"
+    if msg_date == today:  # Mensaje de hoy
+        return f"Hoy {time_str}"
+    elif msg_date == today - timedelta(days=1):  # Mensaje de ayer
+        return f"Ayer {time_str}"
+    elif msg_date.year == today.year:  # Mensaje de este año (pero no hoy ni ayer)
+        return msg_date.strftime(f"%d %b {time_str}")
+    else:  # Mensaje de años anteriores
+        return msg_date.strftime(f"%d/%m/%y {time_str}")
+
+_WIDE = None  # Tabla codepoint -> 1 si ocupa 2 espacios (East Asian Width F/W); se construye al primer uso
+
+def _tabla_anchos():
+    global _WIDE
+    if _WIDE is None:
+        wide = bytearray(0x40000)
+        for cp in range(0x1100, 0x40000):  # Por debajo de U+1100 no hay caracteres anchos
+            if unicodedata.east_asian_width(chr(cp)) in ('F', 'W'):
+                wide[cp] = 1
+        _WIDE = wide
+    return _WIDE
+
+@lru_cache(maxsize=8192)
+def _visual_len(text):  # Ancho visual real de un texto (emojis y CJK ocupan 2 espacios)
+    if text.isascii():  # Caso habitual: todo ASCII, un carácter = un espacio
+        return len(text)
+    if wcswidth is not None:
+        width = wcswidth(text)
+        if width >= 0:
+            return width
+        return sum(max(0, wcwidth(char)) for char in text)  # Hay caracteres de control: los contamos como 0
+    wide = _tabla_anchos()
+    width = len(text)
+    for char in text:  # Sin wcwidth: los anchos dobles salen de la tabla precalculada
+        cp = ord(char)
+        if 0x1100 <= cp < 0x40000 and wide[cp]:
+            width += 1  # Fullwidth/Wide (emojis, CJK): ocupa 2 espacios
+    return width
+
+@lru_cache(maxsize=1024)
+def _display_name(full_name):  # Nombre a mostrar: nombre + primer apellido (se calcula una vez por nombre)
+    name_parts = full_name.split()  # Dividimos por espacios
+    if len(name_parts) >= 2:  # Si hay al menos 2 palabras (nombre y apellido)
+        if "," in full_name:  # Formato certificado: "APELLIDOS, NOMBRE"
+            parts = full_name.split(",")  # Dividimos por coma
+            apellidos = parts[0].strip().split()
+            nombre = parts[1].strip().split()[0] if len(parts) > 1 else ""
+            return f"{nombre} {apellidos[0]}"
+        else:  # Formato normal: "NOMBRE APELLIDO"
+            return f"{name_parts[0]} {name_parts[1]}"
+    return full_name
+
+_TICKS = {'delivered': ("✅", "class:tick-read")}.get  # Estado del mensaje -> (tick, estilo)
+_TICK_DEFAULT = ("🕒", "class:tick-sent")
+
+def _formatear_mensaje(sender, text, timestamp_str, status, my_nick, PAD_WIDTH, today):
+    # Formatea un mensaje del chat: devuelve sus tuplas (estilo, texto) y cuántas líneas ocupa
+    # Es una función pura (solo depende de sus argumentos) para poder cachear su resultado y llamarla fuera de la TUI
+    msg_date, time = _parse_timestamp(timestamp_str)  # Fecha y hora del mensaje (ISO, epoch o "HH:MM")
+    formatted_time = _formato_fecha(time, msg_date, today) # Formateamos el timestamp para mostrar (sin volver a parsear)
+
+    MARGIN = "  "  # Margen izquierdo constante de 2 espacios
+
+    if sender == "Sys":
+        center_pad = " " * max(0, (PAD_WIDTH - _visual_len(text)) // 2)# Calculamos padding para centrar el mensaje
+        formatted_lines = [("", "\n"), ("class:msg-sys", f"{MARGIN}{center_pad}--- {text} ---")] # Separación entre mensajes + mensaje centrado
+        current_lines = 1
+
+    elif status == 'received' or sender != my_nick:
+        text_lines = text.split('\n')
+        # Primera línea: timestamp y nombre del remitente; después las líneas del mensaje con prefijo " > " (todo con el mismo estilo, en una sola tupla)
+        body = f"{MARGIN}[{formatted_time}] {sender}:\n" + "".join(f"{MARGIN} > {line}\n" for line in text_lines)
+        formatted_lines = [("", "\n"), ("class:msg-recv", body)]
+        current_lines = 2 + len(text_lines)
+
+    else:
+        tick, tick_style = _TICKS(status, _TICK_DEFAULT)  # ✅ si hay ACK del destinatario; 🕒 si está enviado sin ACK, pendiente, error...
+        
+        text_lines = text.split('\n')  # Dividimos el mensaje en líneas (soporte multilínea)
+        
+        time_info = f"{formatted_time} {tick}"  # Calculamos el ancho visual del timestamp con el tick
+        time_width = _visual_len(time_info)  # Ancho en caracteres (emojis cuentan como 2)
+        
+        # Todo lo que va sin estilo (separación, líneas intermedias, padding) se acumula y se emite como una sola tupla
+        plain = ["\n"]  # Separación entre mensajes
+        current_lines = 1
+        for line in text_lines[:-1]: # LÍNEAS INTERMEDIAS: solo alinear a la derecha sin timestamp
+            if line.isascii():  # En ASCII el ancho visual es len(): rjust rellena directamente
+                plain.append(MARGIN + line.rjust(PAD_WIDTH) + "\n")
+            else:
+                padding = " " * max(0, PAD_WIDTH - _visual_len(line))
+                plain.append(MARGIN + padding + line + "\n")
+            current_lines += 1
+        
+        line = text_lines[-1]  # ÚLTIMA LÍNEA del mensaje (o la única): intentamos poner timestamp aquí
+        line_width = _visual_len(line)
+        if line_width + time_width + 3 <= PAD_WIDTH:  # +3 para espacios separadores
+            padding = " " * max(0, PAD_WIDTH - line_width - time_width - 3)# SÍ CABE: alineamos todo a la derecha en una sola línea
+            plain.append(MARGIN + padding)  # Espacios a la izquierda
+            formatted_lines = [("", "".join(plain)), ("class:msg-sent", line), ("class:time", f"   {formatted_time} ")]
+        else: # NO CABE: línea de texto aparte + timestamp en línea separada
+            time_padding = " " * max(0, PAD_WIDTH - time_width) # Nueva línea solo para timestamp (alineado a la derecha)
+            if len(text_lines) > 1:  # En los mensajes multilínea la última línea va sin estilo, como las intermedias
+                if line.isascii():
+                    plain.append(MARGIN + line.rjust(PAD_WIDTH) + "\n" + MARGIN + time_padding)
+                else:
+                    plain.append(MARGIN + " " * max(0, PAD_WIDTH - line_width) + line + "\n" + MARGIN + time_padding)
+                formatted_lines = [("", "".join(plain)), ("class:time", f"{formatted_time} ")]
+            else:
+                padding = " " * max(0, PAD_WIDTH - line_width)
+                plain.append(MARGIN + padding)
+                formatted_lines = [("", "".join(plain)), ("class:msg-sent", line + "\n"), ("", MARGIN + time_padding), ("class:time", f"{formatted_time} ")]
+            current_lines += 1
+        formatted_lines.append((tick_style, f"{tick}\n"))  # Tick con salto de línea
+        current_lines += 1
+    
+    return formatted_lines, current_lines
+
 class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Interface)
+    CHAT_OVERSCAN = 50  # Líneas de chat que se formatean por encima de lo visible
+    EVENTOS_INFORMATIVOS = frozenset(("PEER_SENDING_PENDING", "ERROR_DESCIFRADO"))  # Eventos que no cambian nada en la UI ni en la BD
+    HANDSHAKES_EN_PARALELO = 10  # Handshakes de reconexión simultáneos al arrancar
+    CONEXION_POR_EVENTO = {  # Eventos de control que cambian el estado de conexión del contacto
+        "HANDSHAKE_OK_INIT": True,
+        "HANDSHAKE_OK_RESP": True,
+        "SESSION_RESTORED_INIT": True,
+        "SESSION_RESTORED_RESP": True,
+        "RECONNECT_TIMEOUT": False,
+    }
+    
     def __init__(self, protocol, my_nick, db, my_ip="0.0.0.0", my_port=0):  # Constructor: inicializa la TUI
         # Parámetros de inicialización
         self.protocol = protocol  # Referencia al protocolo de red
@@ -22,18 +179,34 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         self.db = db  # Base de datos para almacenar contactos e historial de mensajes
         self.my_ip = my_ip  # Nuestra dirección IP local (obtenida al iniciar el servidor UDP)
         self.my_port = my_port  # Puerto UDP en el que escuchamos conexiones
-        self.contact_keys = []  # Lista de identificadores de contactos (ip:puerto o nombre)
+        self.contact_keys = []  # Lista de identificadores de contactos (ip:puerto o nombre), siempre ordenada
+        self._contact_keys_set = set()  # Los mismos identificadores, para comprobar pertenencia en O(1)
         self.current_cn = None  # Contacto actualmente seleccionado en la interfaz
+        self._current_idx = 0  # Posición de current_cn en [Ayuda, Mi cuenta] + contact_keys (se revalida al navegar)
+        self._current_info = {}  # Datos del contacto seleccionado (el propio dict de la BD, siempre al día)
+        self._current_info_cn = None  # Contacto al que corresponde _current_info
         self.pending_handshakes = set()  # Conjunto de contactos con handshake
         self._timeout_check_task = None  # Tarea que verifica timeouts de ACKs no recibidos
-        self._reconnect_timeout_task = None  # Tarea que intenta reconectar sesiones perdidas
-        self._window_monitor_task = None  # Tarea que detecta cambios de tamaño de ventana
-        self._ui_refresh_task = None  # Tarea que fuerza redibujo constante de la UI
         self.sending_pending = set()  # Contactos que están actualmente enviando mensajes pendientes
-        self.pending_sent = {}  # Diccionario (ip, port) -> bool indicando si ya enviamos nuestros pendientes
+        self.pending_sent = {}  # Diccionario contacto -> bool indicando si ya enviamos nuestros pendientes
+        self._msg_handlers = {  # Eventos de control del protocolo -> método que los atiende
+            "HANDSHAKE_OK_INIT": self._on_handshake_ok,
+            "HANDSHAKE_OK_RESP": self._on_handshake_ok,
+            "SESSION_RESTORED_INIT": self._on_session_restored_init,
+            "SESSION_RESTORED_RESP": self._on_session_restored_resp,
+            "SEND_MY_PENDING": self._on_send_my_pending,
+            "RECONNECT_TIMEOUT": self._on_reconnect_timeout,  # Se marca como desconectado al actualizar el contacto
+        }
+        self._ui_dirty = False  # Hay un refresh_ui programado que aún no se ha ejecutado
         self._last_line_count = 0  # Número de líneas del chat en la última actualización
         self.scroll_offset = 0  # Desplazamiento vertical del scroll 
         self._last_window_width = 0  # Ancho de la ventana de chat en la última actualización
+        self._line_cache = {}  # (contacto, id de mensaje) -> (estado, tuplas ya formateadas, nº de líneas); solo del chat abierto
+        self._line_cache_width = 0  # Ancho con el que se formatearon las líneas guardadas
+        self._line_cache_day = None  # Día con el que se formatearon ("Hoy"/"Ayer" dependen de él)
+        self._help_content = None  # Pestaña de ayuda ya formateada (es texto fijo)
+        self._account_content = None  # (datos mostrados, pestaña "Mi Cuenta" ya formateada)
+        self._contact_row_cache = {}  # contacto -> (estado mostrado, fila del panel de contactos ya generada)
         
         # Sistema de ASCII Art: permite enviar dibujos predefinidos en los mensajes
         self.ascii_art = {}  # Diccionario que almacenará la relacion clave -> dibujo ASCII
@@ -44,6 +217,25 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
                 self.ascii_art = data.get('ascii', {})  # Extraemos la clave 'ascii' del JSON
         except Exception as e:
             print(f"Error cargando ascii.json: {e}")
+        
+        # Índice para las sugerencias: claves en minúsculas agrupadas por cada carácter que contienen
+        # (si una clave contiene el texto escrito, contiene su primer carácter)
+        self._ascii_by_char = {}  # carácter -> [(clave en minúsculas, clave)] en el orden del JSON
+        for key in self.ascii_art:
+            key_lower = key.lower()
+            for char in set(key_lower):
+                self._ascii_by_char.setdefault(char, []).append((key_lower, key))
+        # Textos cortos (1 a 3 caracteres, los que más coincidencias tienen): las 5 primeras sugerencias ya calculadas
+        top5 = {}  # subcadena -> primeras 5 claves que la contienen
+        for key in self.ascii_art:
+            key_lower = key.lower()
+            subs = {key_lower[i:i + n] for n in (1, 2, 3) for i in range(len(key_lower) - n + 1)}
+            for sub in subs:
+                matches = top5.setdefault(sub, [])
+                if len(matches) < 5:
+                    matches.append(key)
+        self._ascii_top5 = {sub: "  Sugerencias: " + ", ".join(matches) for sub, matches in top5.items()}
+        self._ascii_suggestions = lru_cache(maxsize=256)(self._buscar_ascii)  # texto escrito -> línea de sugerencias
 
         self.w_contacts = TextArea(focusable=False, width=35)  # TextArea de solo lectura, 35 caracteres de ancho
         
@@ -107,7 +299,7 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         @kb.add("down")  # Flecha abajo: navegar hacia abajo en la lista de contactos
         def _(e): self.move_selection(1)  
         @kb.add("enter")  # Enter: acción principal (enviar mensaje o iniciar handshake)
-        def _(e): asyncio.create_task(self.handle_enter())  
+        def _(e): self.handle_enter()  # Se ejecuta en el mismo ciclo de la tecla (no hay nada que esperar: el envío solo encola el paquete)
         @kb.add("c-d")  # Ctrl+D: desconectar manualmente del contacto actual
         def _(e): self.force_disconnect() 
         @kb.add("tab")  # Tab: alternar entre campo de mensajes y campo ASCII
@@ -134,8 +326,10 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
             key_bindings=kb, 
             full_screen=True,
             mouse_support=True, 
-            style=style
+            style=style,
+            min_redraw_interval=0.016  # Como mucho ~60 redibujados por segundo: agrupa ráfagas de cambios
         ) # Aplicación principal de la TUI
+        self.app.after_render += self.on_render  # Cambios de tamaño de ventana (sin sondear)
         
         self.load_initial_contacts()  # Recupera todos los contactos guardados en el historial
 
@@ -151,8 +345,9 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
 
     def load_initial_contacts(self):  # Carga los contactos desde la base de datos al iniciar la aplicación
         for cn in self.db.get_all_contacts().keys():  # cn = contact name
-            if cn not in self.contact_keys:  # Evitar duplicados
+            if cn not in self._contact_keys_set:  # Evitar duplicados
                 self.contact_keys.append(cn)  # Añadimos el contacto a la lista interna
+                self._contact_keys_set.add(cn)
         
         self.contact_keys.sort()  # Ordenamos alfabéticamente para visualización consistente
 
@@ -170,7 +365,7 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         elif self.current_cn == "__MI_CUENTA__":
             return "👤 Mi Cuenta"  # Pestaña con info del propio Usuario
         
-        info = self.db.get_contact_info(self.current_cn) # Obtenemos información del contacto desde la base de datos
+        info = self._info_actual() # Obtenemos información del contacto desde la base de datos
         
         status = "🔴 DESCONECTADO"  # Por defecto asumimos desconectado
         if info:
@@ -186,18 +381,7 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
             status = "⏳ CONECTANDO..."
         
         full_name = info.get("name", self.current_cn) if info else self.current_cn  # Nombre completo desde BD
-        name_parts = full_name.split()  # Dividimos por espacios
-        
-        if len(name_parts) >= 2:  # Si hay al menos 2 palabras (nombre y apellido)
-            if "," in full_name:  # Formato "APELLIDOS, NOMBRE"
-                parts = full_name.split(",")  # Dividimos por coma
-                apellidos = parts[0].strip().split() 
-                nombre = parts[1].strip().split()[0] if len(parts) > 1 else ""  
-                display_name = f"{nombre} {apellidos[0]}" 
-            else:  
-                display_name = f"{name_parts[0]} {name_parts[1]}"  
-        else:  
-            display_name = full_name
+        display_name = _display_name(full_name)  # Nombre + primer apellido
         
         return f"Chat con {display_name} [{status}]"  # Título final del panel
 
@@ -211,118 +395,55 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         elif self.current_cn == "__MI_CUENTA__":
             return self.get_my_account_content()  # Devuelve información del usuario local
         
-        msgs = list(self.db.get_history(self.current_cn))  # Recupera todos los mensajes con este contacto
         formatted_lines = []  # Lista de tuplas (estilo, texto) para prompt_toolkit
         
         formatted_lines.append(("", "\n")) # Añadimos un margen superior para que el chat no esté pegado al borde
         
         try: # Calculamos el ancho de la ventana de chat para alinear mensajes a la derecha
             PAD_WIDTH = self.w_chat_window.render_info.window_width if self.w_chat_window.render_info else 80
+            height = self.w_chat_window.render_info.window_height if self.w_chat_window.render_info else 50
         except:  # Si render_info no está disponible, usar 80 caracteres por defecto
             PAD_WIDTH = 80
+            height = 50
         
         PAD_WIDTH = max(40, PAD_WIDTH - 4)  # Reducimos 4 caracteres para dejar márgenes laterales (2 a cada lado)
         current_lines = 1  # Contador de líneas renderizadas (para el sistema de scroll)
         
-        for m in msgs:  # Iteramos por cada mensaje en el historial
-            sender = m.get('sender')  # Quién envió el mensaje (nick, "Sys", etc.)
-            text = m.get('text')  # Contenido del mensaje
-            timestamp_str = m.get('timestamp')  # Marca de tiempo (formato ISO o "HH:MM")
-            status = m.get('status', '')  # Estado: 'sent', 'delivered', 'received', 'pending', etc.
-            
-            if timestamp_str: # Si hay marca de tiempo, intentamos parsearla
-                try:
-                    dt = datetime.fromisoformat(timestamp_str)  # Parseamos ISO format
-                    time = dt.strftime("%H:%M")  # Extraemos solo hora:minuto
-                    full_date = dt.strftime("%Y-%m-%d %H:%M")  # Fecha completa para cálculos
-                except:
-                    # Si falla el parseo, usar el string tal cual
-                    time = timestamp_str if len(timestamp_str) <= 5 else "??:??"
-                    full_date = None
-            else:
-                time = "??:??"  # Timestamp desconocido
-                full_date = None
-            
-            formatted_time = self.format_timestamp(time, full_date) # Formateamos el timestamp para mostrar
-            
-            formatted_lines.append(("", "\n")) # Añadimos separación entre mensajes
-            current_lines += 1
-            
-            MARGIN = "  "  # Margen izquierdo constante de 2 espacios
-
-            if sender == "Sys":
-                center_pad = " " * max(0, (PAD_WIDTH - self.visual_len(text)) // 2)# Calculamos padding para centrar el mensaje
-                formatted_lines.append(("class:msg-sys", f"{MARGIN}{center_pad}--- {text} ---"))
-
-            elif status == 'received' or sender != self.my_nick:
-                formatted_lines.append(("class:msg-recv", f"{MARGIN}[{formatted_time}] {sender}:\n"))# Primera línea: timestamp y nombre del remitente
-                current_lines += 1
-                for line in text.split('\n'):  # Líneas del mensaje con prefijo " > "
-                    formatted_lines.append(("class:msg-recv", f"{MARGIN} > {line}\n"))
-                    current_lines += 1
-
-            else:
-                if status == 'delivered':  # ACK recibido del destinatario
-                    tick = "✅"  
-                elif status == 'sent':  # Enviado pero sin ACK aún
-                    tick = "🕒"  
-                else:  # Cualquier otro estado (pending, error, etc.)
-                    tick = "🕒"
-                
-                text_lines = text.split('\n')  # Dividimos el mensaje en líneas (soporte multilínea)
-                
-                
-                time_info = f"{formatted_time} {tick}"  # Calculamos el ancho visual del timestamp con el tick
-                time_width = self.visual_len(time_info)  # Ancho en caracteres (emojis cuentan como 2)
-                
-                if len(text_lines) > 1:
-                    for i, line in enumerate(text_lines):  # Iteramos línea por línea
-                        line_width = self.visual_len(line)  # Ancho de esta línea específica
-
-                        if i == len(text_lines) - 1:# ÚLTIMA LÍNEA del mensaje: intentamos poner timestamp aquí
-                            if line_width + time_width + 3 <= PAD_WIDTH:  # +3 para espacios separadores
-                                padding = " " * max(0, PAD_WIDTH - line_width - time_width - 3)# SÍ CABE: alineamos todo a la derecha en una sola línea
-                                formatted_lines.append(("", MARGIN + padding))  # Espacios a la izquierda
-                                formatted_lines.append(("class:msg-sent", line))  # Texto del mensaje
-                                formatted_lines.append(("class:time", f"   {formatted_time} "))  # Timestamp
-                                tick_style = "class:tick-read" if status == 'delivered' else "class:tick-sent"
-                                formatted_lines.append((tick_style, f"{tick}\n"))  # Tick con salto de línea
-                                current_lines += 1
-                            else: # NO CABE: línea de texto aparte + timestamp en línea separada
-                                padding = " " * max(0, PAD_WIDTH - line_width)
-                                formatted_lines.append(("", MARGIN + padding + line + "\n")) # Línea de texto
-                                current_lines += 1
-                                time_padding = " " * max(0, PAD_WIDTH - time_width) # Nueva línea solo para timestamp (alineado a la derecha)
-                                formatted_lines.append(("", MARGIN + time_padding))
-                                formatted_lines.append(("class:time", f"{formatted_time} "))
-                                tick_style = "class:tick-read" if status == 'delivered' else "class:tick-sent"
-                                formatted_lines.append((tick_style, f"{tick}\n"))
-                                current_lines += 1
-                        else: # LÍNEAS INTERMEDIAS: solo alinear a la derecha sin timestamp
-                            padding = " " * max(0, PAD_WIDTH - line_width)
-                            formatted_lines.append(("", MARGIN + padding + line + "\n"))
-                            current_lines += 1
-                else: # Mensaje de una sola línea
-                    text_width = self.visual_len(text)  # Ancho total del mensaje
-                    if text_width + time_width + 3 <= PAD_WIDTH: # ¿Cabe texto + timestamp en una línea?
-                        padding = " " * max(0, PAD_WIDTH - text_width - time_width - 3) # SÍ CABE: todo en una línea, alineado a la derecha
-                        formatted_lines.append(("", MARGIN + padding))  # Padding izquierdo
-                        formatted_lines.append(("class:msg-sent", text))  # Mensaje
-                        formatted_lines.append(("class:time", f"   {formatted_time} "))  # Timestamp
-                        tick_style = "class:tick-read" if status == 'delivered' else "class:tick-sent"
-                        formatted_lines.append((tick_style, f"{tick}\n"))  # Tick
-                        current_lines += 1
-                    else: # NO CABE: mensaje muy largo, timestamp en línea separada
-                        padding = " " * max(0, PAD_WIDTH - text_width)
-                        formatted_lines.append(("", MARGIN + padding))
-                        formatted_lines.append(("class:msg-sent", text + "\n"))
-                        current_lines += 1
-                        time_padding = " " * max(0, PAD_WIDTH - time_width)# Nueva línea solo para timestamp (alineado a la derecha)
-                        formatted_lines.append(("", MARGIN + time_padding))
-                        formatted_lines.append(("class:time", f"{formatted_time} "))
-                        tick_style = "class:tick-read" if status == 'delivered' else "class:tick-sent"
-                        formatted_lines.append((tick_style, f"{tick}\n"))
-                        current_lines += 1
+        today = datetime.now().date()
+        if PAD_WIDTH != self._line_cache_width or today != self._line_cache_day: # Si cambia el ancho (o el día: "Hoy"/"Ayer") las líneas guardadas ya no valen
+            self._line_cache.clear()
+            self._line_cache_width = PAD_WIDTH
+            self._line_cache_day = today
+        
+        # Solo formateamos los mensajes que caben en pantalla más el scroll actual y un margen extra:
+        # al subir con Shift+↑ crece scroll_offset y se van cargando mensajes más antiguos.
+        # Con la ventana así acotada se formatean aquí mismo: un pool de procesos haría fork de todo el proceso
+        # (con la sesión PKCS#11 abierta) para ahorrar unos pocos milisegundos
+        needed = height + self.scroll_offset + self.CHAT_OVERSCAN
+        blocks = []  # Mensajes formateados, del más reciente al más antiguo
+        before_id = None
+        while current_lines < needed:
+            msgs = self.db.get_history_tail(self.current_cn, (needed - current_lines) // 3 + 1, before_id=before_id) # ~3 líneas por mensaje
+            if not msgs:
+                break
+            for m in reversed(msgs):
+                key = (self.current_cn, m.get('id') or id(m))  # Los ids los elige el peer: sin el contacto podrían chocar entre chats
+                status = m.get('status', '')
+                cached = self._line_cache.get(key)
+                if cached is None or cached[0] != status: # Solo formateamos los mensajes nuevos o los que han cambiado de estado
+                    lines, n_lines = self.format_message(m, PAD_WIDTH, today)
+                    cached = (status, lines, n_lines)
+                    self._line_cache[key] = cached
+                blocks.append(cached[1])
+                current_lines += cached[2]
+                if current_lines >= needed:
+                    break
+            before_id = msgs[0].get('id')
+            if before_id is None:
+                break
+        
+        for lines in reversed(blocks):
+            formatted_lines.extend(lines)
         
         formatted_lines.append(("", "\n"))  # Margen inferior para que el chat no esté pegado al borde
         current_lines += 1
@@ -330,7 +451,18 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         self._last_line_count = current_lines  # Guardamos el número total de líneas para el scroll
         return formatted_lines  # Devolvemos la lista de tuplas (estilo, texto)
     
+    def format_message(self, m, PAD_WIDTH, today):  # Formatea un mensaje; devuelve sus tuplas (estilo, texto) y cuántas líneas ocupa
+        return _formatear_mensaje(m.get('sender'), m.get('text'), m.get('timestamp'), m.get('status', ''), self.my_nick, PAD_WIDTH, today)
+
     def get_my_account_content(self):  # Genera el contenido de la pestaña "Mi Cuenta"
+        all_info = self.db.get_all_contacts()
+        has_connected = any(all_info[k].get("is_connected", False) for k in self.contact_keys if all_info.get(k))
+        key = (self.my_nick, self.my_ip, self.my_port, has_connected, len(self.contact_keys))
+        if self._account_content is not None and self._account_content[0] == key: # Si nada de lo que se muestra ha cambiado, reutilizamos la última versión
+            formatted_lines = self._account_content[1]
+            self._last_line_count = len(formatted_lines)
+            return formatted_lines
+        
         formatted_lines = []
         formatted_lines.append(("", "\n\n"))
         formatted_lines.append(("class:msg-sys", "╔════════════════════════════════════════════════════════════════════════╗\n"))
@@ -346,7 +478,6 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         formatted_lines.append(("class:msg-recv", "🔌 Puerto UDP:\n"))
         formatted_lines.append(("class:msg-sent", f"   {self.my_port}\n"))
         formatted_lines.append(("", "\n"))
-        has_connected = any(self.db.get_contact_info(k).get("is_connected", False) for k in self.contact_keys if self.db.get_contact_info(k))
         status_icon = "🟢" if has_connected else "🟡" 
         status_text = "En línea" if has_connected else "Disponible"
         formatted_lines.append(("class:msg-recv", "📊 Estado:\n"))
@@ -355,10 +486,15 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         formatted_lines.append(("class:msg-recv", "👥 Contactos:\n"))
         formatted_lines.append(("class:msg-sent", f"   {len(self.contact_keys)} contacto(s)\n"))
         formatted_lines.append(("", "\n\n"))
+        self._account_content = (key, formatted_lines)
         self._last_line_count = len(formatted_lines)
         return formatted_lines
     
     def get_help_content(self):  # Genera el contenido de la pestaña "Ayuda"
+        if self._help_content is not None: # El texto de ayuda es fijo: se genera una sola vez
+            self._last_line_count = len(self._help_content)
+            return self._help_content
+        
         formatted_lines = []
         formatted_lines.append(("", "\n\n"))
         formatted_lines.append(("class:msg-sys", "╔════════════════════════════════════════════════════════════════════════╗\n"))
@@ -388,58 +524,43 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         formatted_lines.append(("class:msg-sent", "   Ctrl + D      Desconectar del usuario actual\n"))
         formatted_lines.append(("class:msg-sent", "   Ctrl + C      Salir de la aplicación\n"))
         formatted_lines.append(("", "\n\n"))
+        self._help_content = formatted_lines
         self._last_line_count = len(formatted_lines)
         return formatted_lines
 
-    def format_timestamp(self, time_str, full_date_str=None):  # Formatea timestamps de forma amigable
-        try:
-            if full_date_str:
-                msg_datetime = datetime.strptime(full_date_str, "%Y-%m-%d %H:%M")
-            else:
-                msg_datetime = datetime.strptime(f"{datetime.now().strftime('%Y-%m-%d')} {time_str}", "%Y-%m-%d %H:%M")
-            
-            now = datetime.now()
-            today = now.date()
-            msg_date = msg_datetime.date()
-
-            if msg_date == today:  # Mensaje de hoy
-                return f"Hoy {time_str}"
-            elif msg_date == today - timedelta(days=1):  # Mensaje de ayer
-                return f"Ayer {time_str}"
-            elif msg_date.year == today.year:  # Mensaje de este año (pero no hoy ni ayer)
-                return msg_datetime.strftime(f"%d %b {time_str}")
-            else:  # Mensaje de años anteriores
-                return msg_datetime.strftime(f"%d/%m/%y {time_str}")
-        except:  # Si falla el parseo, devolver el string original
-            return time_str
-
-    def visual_len(self, text):  # Calcula el ancho visual real de un texto
-        width = 0
-        for char in text:  # Analizamos carácter por carácter
-            ea = unicodedata.east_asian_width(char)  # Obtenemos la categoría del carácter
-            if ea in ('F', 'W'):  # F = Fullwidth, W = Wide (emojis, caracteres CJK)
-                width += 2  # Estos caracteres ocupan 2 espacios en terminal
-            elif ea in ('Na', 'H', 'N', 'A'):  # Caracteres normales (ASCII, letras latinas)
-                width += 1  # Estos ocupan 1 espacio
-            else:
-                width += 1  # Caso por defecto
-        return width
-
     def update_ascii_suggestions(self):  # Actualiza las sugerencias de ASCII Art en tiempo real
         current_text = self.w_ascii.text.strip().lower()  # Obtenemos el texto actual (minúsculas, sin espacios)
         if not current_text:  
             self.w_suggestions.text = ""
             return
         
-        matches = [key for key in self.ascii_art.keys() if current_text in key.lower()] # Buscamos claves de ASCII Art que contengan el texto escrito
+        if len(current_text) <= 3:  # Texto corto: sugerencias ya precalculadas
+            self.w_suggestions.text = self._ascii_top5.get(current_text, "  Sin coincidencias")
+        else:
+            self.w_suggestions.text = self._ascii_suggestions(current_text)
+
+    def _buscar_ascii(self, current_text):  # Genera la línea de sugerencias para un texto (en minúsculas)
+        candidates = self._ascii_by_char.get(current_text[0], ()) # Solo las claves que contienen el primer carácter
+        matches = [key for key_lower, key in candidates if current_text in key_lower] # Buscamos claves de ASCII Art que contengan el texto escrito
         
         if matches:  # Si hay coincidencias, mostramos las primeras 5
-            suggestions_text = "  Sugerencias: " + ", ".join(matches[:5])
-            self.w_suggestions.text = suggestions_text
+            return "  Sugerencias: " + ", ".join(matches[:5])
         else:  # Si no hay coincidencias, mostramos mensaje
-            self.w_suggestions.text = "  Sin coincidencias"
+            return "  Sin coincidencias"
+
+    def refresh_ui(self):  # Pide actualizar la interfaz; todo cambio de estado (mensaje, ACK, handshake, timeout, Enter, Ctrl+D) pasa por aquí y varias llamadas durante un mismo evento se agrupan en una sola
+        if self._ui_dirty:  # Ya hay una actualización programada que recogerá este cambio
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # Sin event loop (arranque): actualizamos directamente
+            self._flush_ui()
+            return
+        self._ui_dirty = True
+        loop.call_soon(self._flush_ui)
 
-    def refresh_ui(self):  # Actualiza la interfaz de usuario
+    def _flush_ui(self):  # Actualiza la interfaz de usuario y pide el redibujado
+        self._ui_dirty = False
         lines = []  # Lista de líneas de texto para el panel de contactos
         special_contacts = ["__AYUDA__", "__MI_CUENTA__"]  # Pestañas de sistema
         
@@ -459,8 +580,11 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
             lines.append("─" * 32)  
             lines.append("") 
         
+        all_info = self.db.get_all_contacts()  # Info y no leídos de todos los contactos sin pedirlos uno a uno
+        unread_counts = self.db.get_unread_counts_bulk(self.my_nick)
+        
         for k in self.contact_keys:  # Iteramos por cada contacto
-            info = self.db.get_contact_info(k)  # Obtenemos info de la base de datos
+            info = all_info.get(k)  # Obtenemos info de la base de datos
             if not info:  # Si no hay info, saltamos este contacto
                 continue
             
@@ -471,62 +595,80 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
             else:  # No hay sesión guardada
                 icon = "🟡"
             
-            prefix = "➞ " if k == self.current_cn else "  " # Marcar contacto actual con flecha
-            
+            selected = k == self.current_cn
             full_name = info.get("name", k) # Nombre completo desde la base de datos
-            name_parts = full_name.split()
-            if len(name_parts) >= 2:  # Extraer nombre + primer apellido
-                if "," in full_name:  # Formato certificado: "APELLIDOS, NOMBRE"
-                    parts = full_name.split(",")
-                    apellidos = parts[0].strip().split()
-                    nombre = parts[1].strip().split()[0] if len(parts) > 1 else ""
-                    display_name = f"{nombre} {apellidos[0]}"
-                else:  # Formato normal: "NOMBRE APELLIDO"
-                    display_name = f"{name_parts[0]} {name_parts[1]}"
-            else:
-                display_name = full_name
-
-            unread = self.db.get_unread_count(k, self.my_nick)  # Cuenta mensajes sin leer
+            unread = unread_counts.get(k, 0)  # Cuenta mensajes sin leer
+            
+            state = (icon, selected, full_name, unread)
+            cached = self._contact_row_cache.get(k)
+            if cached is not None and cached[0] == state: # La fila no ha cambiado: reutilizamos el texto ya generado
+                lines.append(cached[1])
+                continue
+            
+            prefix = "➞ " if selected else "  " # Marcar contacto actual con flecha
+            display_name = _display_name(full_name)  # Extraer nombre + primer apellido
             if unread > 0:  # Si hay mensajes sin leer, mostrar campana 🔔
-                lines.append(f"{prefix}{icon} {display_name} 🔔({unread})")
+                row = f"{prefix}{icon} {display_name} 🔔({unread})"
             else:  # Sin mensajes pendientes
-                lines.append(f"{prefix}{icon} {display_name}")
+                row = f"{prefix}{icon} {display_name}"
+            self._contact_row_cache[k] = (state, row)
+            lines.append(row)
         
-        self.w_contacts.text = "\n".join(lines)  # Unimos todas las líneas con saltos de línea
-        self.app.invalidate()  # Forzamos redibujado de la aplicación prompt_toolkit
+        contacts_text = "\n".join(lines)  # Unimos todas las líneas con saltos de línea
+        if contacts_text != self.w_contacts.text:  # Si el panel no ha cambiado no reescribimos el buffer
+            self.w_contacts.text = contacts_text
+        self.app.invalidate()  # Pedimos redibujado (prompt_toolkit junta varias peticiones seguidas en uno solo)
 
-    def move_selection(self, delta):  # Navega entre contactos (arriba/abajo)
-        all_items = ["__AYUDA__", "__MI_CUENTA__"] + self.contact_keys # Crear lista completa: pestañas especiales + contactos reales
-        
-        if not all_items:  # Si no hay nada, no hacer nada
+    def _add_contact_key(self, cn):  # Añade un contacto a la lista de la UI manteniéndola ordenada (sin reordenarla entera)
+        if cn in self._contact_keys_set:
             return
-        
-        idx = all_items.index(self.current_cn) if self.current_cn in all_items else 0 # Obtener índice actual del contacto seleccionado
-        new_idx = (idx + delta) % len(all_items) # Calcular nuevo índice (con wrap-around: si llegamos al final, volvemos al principio)
-        self.current_cn = all_items[new_idx] # Actualizar contacto actual
+        pos = bisect_left(self.contact_keys, cn)
+        self.contact_keys.insert(pos, cn)
+        self._contact_keys_set.add(cn)
+        if pos + 2 <= self._current_idx: # El contacto seleccionado se ha desplazado una posición
+            self._current_idx += 1
+
+    def _info_actual(self):  # Datos del contacto seleccionado sin volver a buscarlo mientras no cambie la selección
+        # get_contact_info devuelve el dict vivo de la BD, así que guardarlo basta; si aún no existía ({}) lo volvemos a buscar
+        if self._current_info_cn != self.current_cn or not self._current_info:
+            self._current_info_cn = self.current_cn
+            self._current_info = self.db.get_contact_info(self.current_cn) if self.current_cn else {}
+        return self._current_info
+
+    def _item_at(self, idx):  # Elemento en la posición idx de [Ayuda, Mi cuenta] + contact_keys, sin construir esa lista
+        return ("__AYUDA__", "__MI_CUENTA__")[idx] if idx < 2 else self.contact_keys[idx - 2]
+
+    def _indice_actual(self):  # Posición del contacto seleccionado en [Ayuda, Mi cuenta] + contact_keys
+        idx = self._current_idx
+        if idx < len(self.contact_keys) + 2 and self._item_at(idx) == self.current_cn: # Lo normal: la posición guardada sigue siendo válida
+            return idx
+        if self.current_cn == "__MI_CUENTA__":
+            return 1
+        if self.current_cn and self.current_cn != "__AYUDA__": # Ha cambiado la lista o la selección: búsqueda binaria (contact_keys está ordenada)
+            pos = bisect_left(self.contact_keys, self.current_cn)
+            if pos < len(self.contact_keys) and self.contact_keys[pos] == self.current_cn:
+                return pos + 2
+        return 0
+
+    def move_selection(self, delta):  # Navega entre contactos (arriba/abajo)
+        # Calcular nuevo índice (con wrap-around: si llegamos al final, volvemos al principio) sin recorrer la lista de contactos
+        self._current_idx = (self._indice_actual() + delta) % (len(self.contact_keys) + 2)
+        cn = self._item_at(self._current_idx)
+        if cn != self.current_cn:  # Al cambiar de chat las líneas guardadas del anterior ya no se muestran
+            self._line_cache.clear()
+        self.current_cn = cn # Actualizar contacto actual
+        self._info_actual()  # Dejamos preparados sus datos para Enter, Ctrl+D y el título
         self.scroll_offset = 0 # Resetear scroll al cambiar de contacto
 
-        if self.current_cn not in ["__AYUDA__", "__MI_CUENTA__"]: # Si cambiamos a un contacto, marcar mensajes como leídos
+        if self._current_idx >= 2: # Si cambiamos a un contacto, marcar mensajes como leídos
             self.db.mark_messages_as_read(self.current_cn, self.my_nick)
         
         self.refresh_ui()  # Actualizar interfaz para reflejar el cambio
 
     def add_peer(self, name, ip, port):  # Añade un nuevo contacto a la lista evitando duplicados
         
-        existing_cn = None  # Identificador de contacto existente
-        all_contacts = self.db.get_all_contacts()  # Obtenemos todos los contactos de la BD
-        
-        for cn, info in all_contacts.items(): # Primera búsqueda: por IP y puerto
-            if info.get("ip") == ip and info.get("port") == port:  # Coincidencia exacta
-                existing_cn = cn  # Encontramos un contacto con la misma IP:puerto
-                break
-        if not existing_cn: # Segunda búsqueda: por nombre
-            target_name = name.strip().lower()  # Normalizamos el nombre (minúsculas, sin espacios)
-            for cn, info in all_contacts.items():
-                db_name = info.get("name", "").strip().lower()  # Normalizamos nombre en BD
-                if db_name == target_name:  # Coincidencia de nombre
-                    existing_cn = cn
-                    break
+        # Primera búsqueda: por IP y puerto; segunda: por nombre (minúsculas, sin espacios). Ambas con los índices de la BD
+        existing_cn = self.db.get_contact_by_addr(ip, port) or self.db.get_contact_by_name(name)
 
         if existing_cn:  # Si encontramos un contacto existente
             contact_id = existing_cn
@@ -534,9 +676,7 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         else:  # Si es un contacto completamente nuevo
             contact_id = f"{ip}:{port}"  # Usamos "IP:puerto" como identificador
             self.db.add_or_update_contact(contact_id, name=name, ip=ip, port=port)  # Creamos en BD
-            if contact_id not in self.contact_keys:  # Si no está en la lista de UI lo añadimos
-                self.contact_keys.append(contact_id)  
-                self.contact_keys.sort()  
+            self._add_contact_key(contact_id)  # Si no está en la lista de UI lo añadimos
             if not self.current_cn:  # Si no hay contacto seleccionado aún
                 self.current_cn = contact_id
         
@@ -547,92 +687,77 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
             asyncio.create_task(self.auto_connect_and_send_all())  # Intentar reconectar con todos
             return
         
-        if addr is None:  # Si no hay dirección, no podemos procesar el evento
+        if addr is None or text in self.EVENTOS_INFORMATIVOS:  # Sin dirección no podemos procesar el evento; los informativos no requieren nada
             return
 
-        contact_id = None
-        all_contacts = self.db.get_all_contacts()
-        
-        
-        for cn, info in all_contacts.items(): # Búsqueda 1: Por dirección IP y puerto
-            if info.get("ip") == addr[0] and info.get("port") == addr[1]:
-                contact_id = cn
-                break
-        if not contact_id: # Búsqueda 2: Por nombre
-            for cn, info in all_contacts.items():
-                if info.get("name") == real_cn:
-                    contact_id = cn
-                    break
+        # Búsqueda 1: por dirección IP y puerto; búsqueda 2: por nombre (índices de la BD, sin recorrer los contactos)
+        contact_id = self.db.get_contact_by_addr(addr[0], addr[1]) or (self.db.get_contact_by_name(real_cn) if real_cn else None)
         if not contact_id: # Búsqueda 3: Si no existe, usar el nombre real como identificador
             contact_id = real_cn
         if contact_id in self.pending_handshakes: # Si este contacto tenía un handshake pendiente, quitarlo del conjunto
             self.pending_handshakes.discard(contact_id)  # Ya no está "conectando..."
         
-        if contact_id in all_contacts: # Actualizar o crear el contacto en la base de datos Si ya existía
-            self.db.add_or_update_contact(contact_id, ip=addr[0], port=addr[1])  # Actualizar IP/puerto
-        else:  # Si es nuevo
-            self.db.add_or_update_contact(contact_id, name=real_cn, ip=addr[0], port=addr[1])  # Crear nuevo
-        
-        if contact_id not in self.contact_keys: # Añadir a la lista de contactos de la UI si no está
-            self.contact_keys.append(contact_id)
-            self.contact_keys.sort()
-        
-        ts = datetime.now().strftime("%H:%M")  # Timestamp para mensajes del sistema
-        
-        if text in ["HANDSHAKE_OK_INIT", "HANDSHAKE_OK_RESP"]: # HANDSHAKE COMPLETADO
-            self.db.set_contact_connected(contact_id, True) 
-            msgs = self.db.get_history(contact_id) 
-            user_msgs = [m for m in msgs if m.get('sender') != "Sys"]
-            if len(user_msgs) == 0:  # Primera vez que hablamos con este contacto
-                self.db.add_message(contact_id, "Sys", "🔒 Conexión segura establecida", "system", ts)
-            
-            self.protocol.enviar_pending_send(addr[0], addr[1]) # Avisar que vamos a enviar mensajes pendientes
-            self.send_pending_messages(contact_id, addr[0], addr[1], lambda: self.protocol.enviar_pending_done(addr[0], addr[1])) # Enviar todos los mensajes que quedaron pendientes mientras estábamos desconectados
-            self.pending_sent[(addr[0], addr[1])] = True # Marcar que ya enviamos nuestros pendientes (para evitar duplicados)
-        
-        elif text == "SESSION_RESTORED_INIT": # SESIÓN RESTAURADA Iniciar
-            self.db.set_contact_connected(contact_id, True)
-            self.protocol.enviar_pending_send(addr[0], addr[1]) # Enviar pendientes
-            self.send_pending_messages(contact_id, addr[0], addr[1], lambda: self.protocol.enviar_pending_done(addr[0], addr[1]))
-            self.pending_sent[(addr[0], addr[1])] = True
-        
-        elif text == "SESSION_RESTORED_RESP": # SESIÓN RESTAURADA Responder
-            self.db.set_contact_connected(contact_id, True)
-            self.pending_sent[(addr[0], addr[1])] = False  # Esperamos a que el iniciador envíe sus pendientes primero
-        
-        elif text == "PEER_SENDING_PENDING": # Nos indica que va a enviarnos mensajes pendientes
-            pass  # Solo informativo, no hacemos nada
-        
-        elif text == "SEND_MY_PENDING": # Nos indica que quiere que le enviemos nuestros mensajes pendientes
-            if not self.pending_sent.get((addr[0], addr[1]), False): # Solo enviar si aún no lo hemos hecho (evitar duplicados)
-                self.pending_sent[(addr[0], addr[1])] = True
-                self.protocol.enviar_pending_send(addr[0], addr[1])
-                self.send_pending_messages(contact_id, addr[0], addr[1], lambda: self.protocol.enviar_pending_done(addr[0], addr[1]))
-        
-        elif text == "RECONNECT_TIMEOUT": # Timeout de reconexión
-            self.db.set_contact_connected(contact_id, False)  # Marcar como desconectado
-            self.refresh_ui() 
-            return  # No procesamos más, terminamos aquí
-        
-        elif text.startswith("HANDSHAKE_ERROR"): # Error en el Handshake
-            self.db.set_contact_connected(contact_id, False)  # Marcar como desconectado
+        # Actualizar o crear el contacto (IP/puerto, y el nombre si es nuevo) junto con el estado de conexión que implica el evento
+        datos = {"ip": addr[0], "port": addr[1]}
+        if contact_id not in self.db.get_all_contacts():
+            datos["name"] = real_cn
+        self.db.upsert_contact_state(contact_id, is_connected=self._conexion_por_evento(text), **datos)
         
+        self._add_contact_key(contact_id) # Añadir a la lista de contactos de la UI si no está
         
-        elif text == "ERROR_DESCIFRADO": # Error de descifrado (mensaje corrupto o clave incorrecta)
-            pass  # Solo informativo, el protocolo ya maneja el error
+        handler = self._msg_handlers.get(text)  # Eventos de control: un solo acceso al diccionario
+        if handler is not None:
+            handler(contact_id, addr[0], addr[1])
         
         elif text.startswith("ACK|"): # ACK recibido 
-            ack_msg_id = text.split('|', 1)[1]  # Extraemos el ID del mensaje confirmado
+            ack_msg_id = text.partition('|')[2]  # Extraemos el ID del mensaje confirmado
             self.db.mark_message_status(contact_id, ack_msg_id, "delivered") # Actualizar estado del mensaje: 🕒 (sent) -> ✅ (delivered)
         
+        elif text.startswith("HANDSHAKE_ERROR"): # Error en el Handshake (ya marcado como desconectado)
+            pass
+        
         else: # Mensaje normal recibido
-            self.db.set_contact_connected(contact_id, True)  # Asegurar que está marcado como conectado
-            received_msg_id = self.db.add_message(contact_id, real_cn, text, "received", ts, msg_id=msg_id) # Añadir mensaje al historial con estado "received"
-            if self.current_cn == contact_id: # Si estamos viendo el chat con este contacto, marcar como leído inmediatamente
-                self.db.mark_message_as_read_by_id(contact_id, received_msg_id)
+            ts = time.time()
+            # Añadir mensaje al historial con estado "received"; si estamos viendo el chat con este contacto, se guarda ya como leído
+            self.db.add_message(contact_id, real_cn, text, "received", ts, msg_id=msg_id, read=self.current_cn == contact_id)
         
         self.refresh_ui()  # Actualizar interfaz para reflejar cambios
 
+    def _conexion_por_evento(self, text): # Estado de conexión en que deja al contacto cada evento (None: no lo cambia)
+        if text in self.CONEXION_POR_EVENTO:
+            return self.CONEXION_POR_EVENTO[text]
+        if text in self._msg_handlers or text.startswith("ACK|"):
+            return None
+        if text.startswith("HANDSHAKE_ERROR"):
+            return False
+        return True  # Mensaje normal: si nos escribe, está conectado
+
+    def _on_handshake_ok(self, contact_id, ip, port): # HANDSHAKE COMPLETADO
+        if not self.db.has_user_messages(contact_id):  # Primera vez que hablamos con este contacto
+            ts = time.time()  # Timestamp (epoch) para mensajes del sistema
+            self.db.add_message(contact_id, "Sys", "🔒 Conexión segura establecida", "system", ts)
+        
+        self.protocol.enviar_pending_send(ip, port) # Avisar que vamos a enviar mensajes pendientes
+        self.send_pending_messages(contact_id, ip, port, lambda: self.protocol.enviar_pending_done(ip, port)) # Enviar todos los mensajes que quedaron pendientes mientras estábamos desconectados
+        self.pending_sent[contact_id] = True # Marcar que ya enviamos nuestros pendientes (para evitar duplicados)
+
+    def _on_session_restored_init(self, contact_id, ip, port): # SESIÓN RESTAURADA Iniciar
+        self.protocol.enviar_pending_send(ip, port) # Enviar pendientes
+        self.send_pending_messages(contact_id, ip, port, lambda: self.protocol.enviar_pending_done(ip, port))
+        self.pending_sent[contact_id] = True
+
+    def _on_session_restored_resp(self, contact_id, ip, port): # SESIÓN RESTAURADA Responder
+        self.pending_sent[contact_id] = False  # Esperamos a que el iniciador envíe sus pendientes primero
+
+    def _on_send_my_pending(self, contact_id, ip, port): # Nos indica que quiere que le enviemos nuestros mensajes pendientes
+        if not self.pending_sent.get(contact_id, False): # Solo enviar si aún no lo hemos hecho (evitar duplicados)
+            self.pending_sent[contact_id] = True
+            self.protocol.enviar_pending_send(ip, port)
+            self.send_pending_messages(contact_id, ip, port, lambda: self.protocol.enviar_pending_done(ip, port))
+
+    def _on_reconnect_timeout(self, contact_id, ip, port): # RECONNECT_TIMEOUT: ya se marcó como desconectado al actualizar el contacto
+        pass
+
     def send_pending_messages(self, cn, ip, port, callback=None): # Envía todos los mensajes pendientes de un contacto (tras reconectar o handshake)
         pending = self.db.get_pending_messages(cn)  # Obtener mensajes con estado "pending"
         
@@ -648,16 +773,19 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         
         self.sending_pending.add(cn) # Añadir contacto al conjunto de "enviando pendientes" (evita re-entrada)
         
-        async def send_all_async(): # Función asíncrona interna que envía mensajes uno por uno, el delay entre mensajes es importante para no saturar la red
+        async def send_all_async(): # Función asíncrona interna que envía los mensajes uno por uno, cediendo el event loop cada pocos mensajes
             
-            for msg in pending:  # Iteramos por cada mensaje pendiente
+            enviados = []
+            for i, msg in enumerate(pending, 1):  # Iteramos por cada mensaje pendiente
                 self.protocol.enviar_mensaje(ip, port, msg['text'], msg['id']) # Enviar mensaje por la red
-                self.db.mark_message_status(cn, msg['id'], "sent") # Actualizar estado en BD
+                enviados.append(msg['id'])
 
-                await asyncio.sleep(0.2) # Delay crítico: da tiempo al event loop para procesar otros eventos. Sin esto, la UI se congelaría durante el envío masivo
-                
-                self.refresh_ui()
+                if i % 10 == 0: # Cada 10 mensajes cedemos el event loop (sin esperar): la UI y los ACKs siguen atendiéndose durante el envío masivo
+                    await asyncio.sleep(0)
+                    self.refresh_ui()
             
+            # Actualizar estado en BD de todos a la vez (una sola escritura); los que ya tienen ACK se quedan en "delivered"
+            self.db.mark_messages_status_batch(cn, enviados, "sent", from_status="pending")
             self.sending_pending.discard(cn)
             self.refresh_ui()
             
@@ -666,7 +794,7 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
 
         asyncio.create_task(send_all_async()) # Lanzar la tarea asíncrona (no bloqueante)
 
-    async def handle_enter(self):  # Maneja la pulsación de Enter
+    def handle_enter(self):  # Maneja la pulsación de Enter
         
         
         if self.current_cn in ["__AYUDA__", "__MI_CUENTA__"]: # Si estamos en pestañas de ayuda o cuenta, Enter no hace nada
@@ -681,12 +809,12 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
                 
                 if not self.current_cn: # Validaciones básicas
                     return
-                info = self.db.get_contact_info(self.current_cn)
+                info = self._info_actual()
                 if not info:
                     return
                 
                 ip, port = info.get("ip"), info.get("port")
-                ts = datetime.now().strftime("%H:%M")
+                ts = time.time()
                 
                 if not ip or not self.protocol.tiene_sesion(ip, port): # Si no hay sesión, guardar como pendiente e iniciar handshake
                     self.db.add_message(self.current_cn, self.my_nick, ascii_text, "pending", ts)
@@ -711,12 +839,12 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
             self.w_input.text = ""
             return
         
-        info = self.db.get_contact_info(self.current_cn)
+        info = self._info_actual()
         if not info:  # Contacto no encontrado en BD (no debería pasar)
             return
         
         ip, port = info.get("ip"), info.get("port")
-        ts = datetime.now().strftime("%H:%M")
+        ts = time.time()
         
         if not ip: # Si el contacto no tiene IP (offline), mostrar error
             if text:  # Solo si el usuario escribió algo
@@ -754,11 +882,11 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         if not self.current_cn:  # Sin contacto seleccionado, no hacer nada
             return
         
-        info = self.db.get_contact_info(self.current_cn)
+        info = self._info_actual()
         if info and info.get("ip"):  # Si el contacto tiene IP
             self.protocol.cerrar_sesion(info["ip"], info["port"]) # Cerrar sesión en el protocolo 
             self.db.set_contact_connected(self.current_cn, False) # Marcar como desconectado en BD
-            ts = datetime.now().strftime("%H:%M") # Añadir mensaje de sistema informativo
+            ts = time.time() # Añadir mensaje de sistema informativo
             self.db.add_message(self.current_cn, "Sys", "Desconectado manualmente", "system", ts)
             self.refresh_ui()
 
@@ -766,97 +894,51 @@ class ChatTUI: # Clase principal de la interfaz de usuario (TUI = Text User Inte
         
         await asyncio.sleep(0.5)  # Delay inicial para dar tiempo a que todo se inicialice
         all_contacts = list(self.db.get_all_contacts().items()) # Obtener todos los contactos de la BD
+        sem = asyncio.Semaphore(self.HANDSHAKES_EN_PARALELO)  # Varios handshakes a la vez, pero sin lanzarlos todos de golpe
         
-        for cn, info in all_contacts: # Intentar handshake con cada contacto
-            ip = info.get("ip")
-            port = info.get("port")
-            if not ip or not port:  # Si no hay IP/puerto, saltar
-                continue
-
-            self.protocol.enviar_handshake(ip, port, cn=cn) # Enviar handshake 
-            await asyncio.sleep(0.1)  # Pequeño delay entre handshakes
+        async def conectar(cn, ip, port):
+            async with sem:
+                self.protocol.enviar_handshake(ip, port, cn=cn) # Enviar handshake 
+                await asyncio.sleep(0.05)  # Pequeño delay antes de liberar el hueco para el siguiente
+        
+        destinos = [(cn, info.get("ip"), info.get("port")) for cn, info in all_contacts]  # Un solo acceso a cada campo
+        await asyncio.gather(*(conectar(cn, ip, port) for cn, ip, port in destinos if ip and port))  # Handshake con cada contacto que tenga IP/puerto
         
         self.refresh_ui()  # Actualizar UI
 
-    async def monitor_window_size(self):  # Monitorea cambios en el tamaño de la ventana terminal
-        
-        while True:
-            await asyncio.sleep(0.1)  # Verificar cada 100ms
-            try:
-                if self.w_chat_window.render_info:  # Si hay info de renderizado disponible
-                    current_width = self.w_chat_window.render_info.window_width
-                    if current_width != self._last_window_width and current_width > 0: # Si el ancho cambió, forzar redibujado
-                        self._last_window_width = current_width
-                        if self.app:
-                            self.app.invalidate()  # Redibuja toda la interfaz
-            except:
-                pass  # Ignorar errores (puede que render_info no esté disponible aún)
+    def on_render(self, _app):  # Tras cada redibujado: detecta cambios de tamaño de la ventana
+        # prompt_toolkit ya redibuja al cambiar el tamaño del terminal (SIGWINCH en Unix, sondeo propio en Windows),
+        # pero ese primer redibujado usa el ancho anterior del chat: si ha cambiado pedimos otro con el ancho nuevo
+        # No registramos nuestro propio manejador de SIGWINCH: loop.add_signal_handler sustituiría al de prompt_toolkit
+        # y en Windows no existe; engancharnos al redibujado cubre las dos plataformas sin ninguna tarea periódica
+        info = self.w_chat_window.render_info
+        if info and info.window_width != self._last_window_width and info.window_width > 0:
+            self._last_window_width = info.window_width
+            self.app.invalidate()  # Redibuja toda la interfaz (el caché de líneas se invalida al ver el ancho nuevo)
     
-    async def force_ui_refresh(self):  # Fuerza redibujado constante de la UI
-        while True:
-            await asyncio.sleep(0.05)  # Cada 50ms (20 veces por segundo)
-            try:
-                if self.app:
-                    self.app.invalidate()  # Forzar redibujado completo
-            except:
-                pass  # Ignorar errores
-
     async def check_ack_timeouts(self):  # Comprueba timeouts de ACKs no recibidos
         while True:
             await asyncio.sleep(0.5)  # Verificar cada 500ms
             
-            for cn in list(self.contact_keys):  # Iterar por cada contacto
-                if cn in self.sending_pending: # Si estamos enviando pendientes, no verificar timeouts
-                    continue
-                
-                info = self.db.get_contact_info(cn)
-                if info and info.get("is_connected"):  # Solo verificar si está marcado como conectado
-                    has_timeout = self.db.check_message_timeouts(cn, timeout_seconds=0.5) # Verificar si hay mensajes con timeout (sin ACK en >0.5s)
-                    
-                    if has_timeout:  # Si hay timeout, asumir desconexión
-                        self.db.set_contact_connected(cn, False)  # Marcar como desconectado
-                        ip = info.get("ip")
-                        port = info.get("port")
-                        if ip and port:
-                            self.protocol.cerrar_sesion(ip, port)  # Cerrar sesión en protocolo
-                        
-                        msgs = self.db.get_history(cn) # Todos los mensajes "sent" vuelven a "pending" (se reenviarán al reconectar)
-                        for msg in msgs:
-                            if msg.get("status") == "sent":
-                                self.db.mark_message_status(cn, msg["id"], "pending")
-                        
-                        self.refresh_ui()
-
-    async def _keep_loop_awake(self):  # Tarea especial para Windows: mantener el event loop activo
-        import socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Socket UDP
-        sock.bind(('127.0.0.1', 0))  # Bind a localhost en puerto aleatorio
-        addr = sock.getsockname()  # Obtener dirección
-        sock.setblocking(False)  # No bloquear en recv 
-        
-        while True:
-            await asyncio.sleep(0.1)  # Cada 100ms
-            try:
-                sock.sendto(b'wake', addr) # Enviar paquete a nosotros mismos (genera evento de I/O)
-                try: # Leer para vaciar el buffer (evitar acumulación)
-                    sock.recv(1024)  # Intentar recibir
-                except BlockingIOError:  # Es normal que falle (socket no bloqueante)
-                    pass
-            except:
-                pass  # Ignorar cualquier error (no crítico)
+            # Una sola pasada por todos los contactos conectados (sin ACK en >0.5s); si estamos enviando pendientes a uno, no lo verificamos
+            # La base de datos ya devuelve sus mensajes "sent" a "pending" (se reenviarán al reconectar)
+            timed_out = self.db.batch_get_timed_out_contacts(timeout_seconds=0.5, exclude=self.sending_pending)
+            
+            for cn, ip, port, _ in timed_out:  # Si hay timeout, asumir desconexión
+                self.db.set_contact_connected(cn, False)  # Marcar como desconectado
+                if ip and port:
+                    self.protocol.cerrar_sesion(ip, port)  # Cerrar sesión en protocolo
+            
+            if timed_out:
+                self.refresh_ui()
 
     async def run(self):  # Función principal que ejecuta la TUI y todas las tareas en background
         self._timeout_check_task = asyncio.create_task(self.check_ack_timeouts())  # Verificar timeouts de ACKs
-        self._reconnect_timeout_task = asyncio.create_task(self.protocol.check_reconnect_timeouts())  # Verificar timeouts de reconexión (protocol.py)
-        self._window_monitor_task = asyncio.create_task(self.monitor_window_size())  # Monitorear redimensionado de terminal
-        self._ui_refresh_task = asyncio.create_task(self.force_ui_refresh())  # Refrescar UI constantemente
-        self._wakeup_task = asyncio.create_task(self._keep_loop_awake())  # Mantener event loop despierto (Windows fix)
         
         try: # Ejecutar la aplicación prompt_toolkit (bloquea hasta que el usuario salga con Ctrl+C)
             await self.app.run_async()
         finally: # Limpiar al salir
-            for task in [self._timeout_check_task, self._reconnect_timeout_task, 
-                         self._window_monitor_task, self._ui_refresh_task, self._wakeup_task]:
+            for task in [self._timeout_check_task]:
                 if task:  # Si la tarea fue creada
                     task.cancel()  # Solicitar cancelación
                     try:
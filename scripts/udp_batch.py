@@ -0,0 +1,135 @@
+# udp_batch.py
+# Envío y recepción de varios datagramas UDP en una sola llamada al sistema (sendmmsg/recvmmsg) en Linux
+import ctypes
+import socket
+import struct
+import sys
+
+BATCH_MAX = 100  # Máximo de datagramas por llamada (a partir de aquí apenas se gana nada)
+RECV_BATCH = 32  # Datagramas que leemos como mucho en cada recvmmsg
+RECV_SIZE = 65536  # Tamaño de cada buffer de recepción (cabe el mayor datagrama UDP)
+MSG_DONTWAIT = 0x40
+SOCKADDR_CACHE_MAX = 128  # Direcciones de destino ya empaquetadas que guardamos como mucho
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+_sendmmsg = None
+_recvmmsg = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+        _recvmmsg = _libc.recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _sendmmsg = None
+        _recvmmsg = None
+
+def disponible():
+    return _sendmmsg is not None
+
+def recv_disponible():
+    return _recvmmsg is not None
+
+_sockaddr_cache = {}  # (ip, puerto) -> sockaddr_in ya empaquetado (LRU limitada a SOCKADDR_CACHE_MAX)
+
+def _sockaddr_in(addr):
+    sa = _sockaddr_cache.pop(addr, None)
+    if sa is None:
+        ip, port = addr
+        sa = struct.pack("=H", socket.AF_INET) + struct.pack(">H", port) + socket.inet_aton(ip) + bytes(8)
+        if len(_sockaddr_cache) >= SOCKADDR_CACHE_MAX:
+            _sockaddr_cache.pop(next(iter(_sockaddr_cache))) # Sacamos la entrada menos usada
+    _sockaddr_cache[addr] = sa  # Lo que se usa pasa al final
+    return sa
+
+def _puntero(data): # Puntero C al contenido de un bytes o bytearray (sin copiarlo)
+    if isinstance(data, bytearray):
+        return (ctypes.c_char * len(data)).from_buffer(data)
+    return ctypes.c_char_p(data)
+
+def sendmmsg(fd, paquetes):
+    # paquetes: lista de (datos, (ip, puerto)) IPv4, como mucho BATCH_MAX
+    # datos puede ser bytes/bytearray o una tupla de trozos, que se envían como un solo datagrama (iovec)
+    # Devuelve cuántos se han enviado (pueden ser menos si el buffer del socket está lleno)
+    n = len(paquetes)
+    msgs = (_mmsghdr * n)()
+    trozos = [data if isinstance(data, tuple) else (data,) for data, _ in paquetes]
+    iovs = (_iovec * sum(len(t) for t in trozos))()
+    refs = []  # Mantiene vivos los buffers mientras dura la llamada
+    k = 0
+    for i, (partes, (_, addr)) in enumerate(zip(trozos, paquetes)):
+        primero = k
+        for parte in partes:
+            buf = _puntero(parte)
+            refs.append(buf)
+            iovs[k].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+            iovs[k].iov_len = len(parte)
+            k += 1
+        sa = ctypes.c_char_p(_sockaddr_in(addr))
+        refs.append(sa)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.cast(sa, ctypes.c_void_p)
+        hdr.msg_namelen = 16
+        hdr.msg_iov = ctypes.pointer(iovs[primero])
+        hdr.msg_iovlen = len(partes)
+    enviados = _sendmmsg(fd, msgs, n, MSG_DONTWAIT)
+    if enviados < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "sendmmsg")
+    return enviados
+
+class Receptor: # recvmmsg sobre buffers reservados una sola vez
+    def __init__(self, fd, n=RECV_BATCH, size=RECV_SIZE):
+        self.fd = fd
+        self.n = n
+        self._buf = bytearray(n * size)
+        self._view = memoryview(self._buf)
+        self._names = (ctypes.c_char * (16 * n))()
+        self._iovs = (_iovec * n)()
+        self._msgs = (_mmsghdr * n)()
+        self._size = size
+        base = ctypes.addressof((ctypes.c_char * len(self._buf)).from_buffer(self._buf))
+        names = ctypes.addressof(self._names)
+        for i in range(n):
+            self._iovs[i].iov_base = base + i * size
+            self._iovs[i].iov_len = size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names + i * 16
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recibir(self):
+        # Devuelve [(vista, (ip, puerto))]; las vistas apuntan a los buffers y se reutilizan en la siguiente llamada
+        for i in range(self.n):
+            self._msgs[i].msg_hdr.msg_namelen = 16
+        recibidos = _recvmmsg(self.fd, self._msgs, self.n, MSG_DONTWAIT, None)
+        if recibidos < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "recvmmsg")
+        resultado = []
+        for i in range(recibidos):
+            # Sin caché: la dirección de origen la decide quien envía el datagrama (aún sin autenticar) y convertirla es barato
+            raw = self._names[i * 16:i * 16 + 8]
+            addr = (socket.inet_ntoa(raw[4:8]), int.from_bytes(raw[2:4], "big"))
+            inicio = i * self._size
+            resultado.append((self._view[inicio:inicio + self._msgs[i].msg_len], addr))
+        return resultado